@@ -0,0 +1 @@
+# Makes the repository root importable by the tests (`from src.xxx import ...`), as for `python -m src.xxx.exec`.
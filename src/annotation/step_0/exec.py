@@ -1,55 +1,56 @@
-import re
 import os
 import argparse
 import json
-import shutil
-from collections import defaultdict
+import sys
 
+import src.rocq.lexer
+from src.rocq.lexer import strip_source, collapse_blank_lines, strip_content
+from src.rocq.library import source_files, module_name, map_files, sync_other_files, tool_version, Manifest
 
-def remove_proofs(content: str) -> str:
-    pattern = r'Proof\.(.*?)(Qed\.|Abort\.|Defined\.)'
-    to_do = []
-    for match in re.finditer(pattern, content, flags=re.DOTALL):
-        start, end = match.start(0), match.end(0)
-        to_do.append((start, end))
-    to_do = sorted(to_do, reverse=True)
-    for start, end in to_do:
-        content = content[:start] + content[end:]
-    return content
+def process_file(relpath: str, library_dir: str, export_dir: str):
+    """Remove proofs, comments and extra blank lines of one library file, write it in export_dir and return its line map."""
+    filepath = os.path.join(library_dir, relpath)
+    with open(filepath, 'r') as file:
+        content = file.read()
+    assert (content.count('Proof.') - content.count('Qed.') - content.count('Abort.')) - content.count('Defined.')==0, f"Issue, source file {filepath} contains proofs that are not well contained in a Proof.[..]Qed. block"
 
-def remove_comments(content: str) -> str:
-    """Remove Rocq comments in a file."""
-    pattern = r"\(\*[\s\S]*?\*\)"
-    match = re.search(pattern, content, flags=re.DOTALL)
-    while match:
-        content = content[:match.start()] + content[match.end():]
-        match = re.search(pattern, content)
-    return content
-
-def remove_blank(content: str) -> str:
-    while '\n\n\n' in content:
-        content = content.replace('\n\n\n', '\n\n')
-    return content
+    content, line_map = strip_source(content)
+    content, line_map = collapse_blank_lines(content, line_map)
+    # stripped as step_1 does, so that the line numbers of step_1 are the ones of line_map
+    content, line_map = strip_content(content, line_map)
+    filepath = os.path.join(export_dir, relpath)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'w') as file:
+        file.write(content)
+    return line_map
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parse library to extract modules skeleton.")
     parser.add_argument("--library-dir", default="export/mathcomp/", help="Directory for output images")
     parser.add_argument("--export-dir", default="export/output/step_0")
+    parser.add_argument("--max-workers", default=os.cpu_count(), type=int, help="Number of processes used to preprocess files (1 to stay in this process)")
+    parser.add_argument("--force", action='store_true', help="Process every file, even the ones unchanged since the last run")
     args = parser.parse_args()
 
-    shutil.copytree(args.library_dir, args.export_dir, dirs_exist_ok=True)
-    output = {}
-    stats = defaultdict(lambda:0)
-    for (root,dirs,files) in os.walk(args.export_dir, topdown=True):
-        for file in files:
-            if file.endswith('.v'):
-                filepath = os.path.join(root, file)
-                with open(filepath, 'r') as file:
-                    content = file.read()
-                assert (content.count('Proof.') - content.count('Qed.') - content.count('Abort.')) - content.count('Defined.')==0, f"Issue, source file {filepath} contains proofs that are not well contained in a Proof.[..]Qed. block"
-            
-                content = remove_proofs(content)
-                content = remove_comments(content)
-                content = remove_blank(content)
-                with open(filepath, 'w') as file:
-                    file.write(content)
+    line_map_path = os.path.join(args.export_dir, 'line_map.json')
+    previous = {}
+    if os.path.exists(line_map_path) and not args.force:
+        with open(line_map_path, 'r') as file:
+            previous = json.load(file)
+
+    # only the files whose content (or this step's code) changed since the last run are processed again
+    manifest = Manifest(args.export_dir, tool_version(sys.modules[__name__], src.rocq.lexer))
+    relpaths = source_files(args.library_dir)
+    digests, stale = manifest.stale_files(args.library_dir, relpaths, lambda relpath: module_name(relpath) in previous)
+    sync_other_files(args.library_dir, args.export_dir, skip=(Manifest.FILE, 'line_map.json'))
+    manifest.remove_deleted(relpaths)
+    line_maps = dict(zip(stale, map_files(process_file, stale, args.library_dir, args.export_dir, max_workers=args.max_workers)))
+    print(f"Processed {len(stale)} files, reused {len(relpaths) - len(stale)}")
+
+    # line_map.json gives, for each line of the preprocessed files, its line in the library
+    with open(line_map_path, 'w') as file:
+        json.dump({
+            module_name(relpath): line_maps[relpath] if relpath in line_maps else previous[module_name(relpath)]
+            for relpath in relpaths
+        }, file)
+    manifest.save(digests)
@@ -1,14 +1,11 @@
 import os
-import random
 import argparse
-import time
-import random
-import concurrent.futures
+import asyncio
 import re
 
 import yaml
-from openai import OpenAI
-from tqdm import tqdm
+
+from src.llm.client import LLMClient, gather_with_progress
 
 class NoCodeFound(Exception):
     def __init__(self, message):
@@ -34,26 +31,21 @@ def extract_code(content: str):
         raise NoCodeFound(f"No code found in {content}")
     return match.group(1)
 
-def generate_output(prompt, client, config):
+async def generate_output(prompt, client: LLMClient):
     """
-    Sends prompt to client using config.
+    Sends prompt to client.
     """
-    completion = client.chat.completions.create(
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        **config
-    )
-    return extract_code(completion.choices[0].message.content)
-
-def process_prompt(prompt, export_path, export_prompt_path, prompt_export_template, client, config, delay=0, max_retry=3):
+    return await client.complete([
+        {"role": "user", "content": prompt}
+    ], parse=extract_code)
+
+async def process_prompt(prompt, export_path, export_prompt_path, prompt_export_template, client: LLMClient, max_retry=3):
     """
     Executes generation according to prompt
     """
-    time.sleep(delay)
     for k in range(max_retry):
         try:
-            output = generate_output(prompt, client, config)
+            output = await generate_output(prompt, client)
             with open(export_path, 'w') as file:
                 file.write(output)
             with open(export_prompt_path, 'w') as file:
@@ -73,8 +65,8 @@ if __name__ == '__main__':
     parser.add_argument('--config-dir', default='config/step_1_bis')
     parser.add_argument('--export-prompt-path', default='config/step_2/prompts/', help='Directory to export prompt')
     parser.add_argument('--max-retry', default=3, type=int, help='Max number of retry before having a correct code block')
-    parser.add_argument('--max-workers', default=100, type=int, help='Max number of concurrent workers')
-    parser.add_argument('--mean-delay', default=10, type=int, help='Mean delay before a request is send: use this parameter to load balance')
+    parser.add_argument('--max-concurrency', default=None, type=int, help='Upper bound of concurrent requests (default: rate_limit.max_concurrency of config.yaml)')
+    parser.add_argument('--no-cache', action='store_true', help='Always send requests, without reading or writing the completion cache (e.g. to sample new outputs)')
 
     args = parser.parse_args()
 
@@ -87,11 +79,6 @@ if __name__ == '__main__':
     with open(prompt_export_path, 'r') as file:
         prompt_export_template = file.read()
 
-    client = OpenAI(
-        base_url=config['base_url'],
-        api_key=os.getenv("OPENAI_API_KEY")
-    )
-    
     to_do = []
     prompt_template_path = os.path.join(args.config_dir, 'prompt.txt')
     with open(prompt_template_path, 'r') as file:
@@ -109,9 +96,12 @@ if __name__ == '__main__':
                 export_prompt_path = os.path.join(args.export_prompt_path, f'prompt_{file.removesuffix('.v')}.txt')
                 if not os.path.exists(export_path):
                     to_do.append((prompt, export_path, export_prompt_path))
-    delay_max = args.mean_delay*2
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:  # Adjust the number of workers as needed
-        futures = []
-        futures += [executor.submit(process_prompt, prompt, export_path, export_prompt_path, prompt_export_template, client, config['request_config'], delay=random.randint(0, delay_max), max_retry=args.max_retry) for prompt, export_path, export_prompt_path in to_do]
-        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
-            pass
\ No newline at end of file
+
+    async def main():
+        client = LLMClient.from_config(config, max_concurrency=args.max_concurrency, use_cache=not args.no_cache)
+        try:
+            await gather_with_progress(process_prompt(prompt, export_path, export_prompt_path, prompt_export_template, client, max_retry=args.max_retry) for prompt, export_path, export_prompt_path in to_do)
+        finally:
+            await client.close()
+        print(client.summary())
+    asyncio.run(main())
@@ -1,16 +1,19 @@
 import os
-import random
+import sys
 import argparse
-import time
-import random
+import asyncio
 import json
-import concurrent.futures
 import re
+import glob
 
 import yaml
-from openai import OpenAI
-from tqdm import tqdm
 
+from src.llm.client import LLMClient, gather_grouped
+from src.llm.batch import BatchJob
+from src.llm.chunking import plan_chunks, chunk_report
+from src.llm.tokens import load_token_counter
+from src.llm.prefix import split_template, prefix_messages, cached_prefix_report
+from src.llm.streaming import ItemsParser
 
 from Levenshtein import distance
 
@@ -24,17 +27,70 @@ class OutOfTolerance(Exception):
         self.message = message
         super().__init__(self.message)
 
-def generate_output(prompt, client, config):
+def name_distance(entry_output, name_data):
     """
-    Sends prompt to client using config.
+    Levenshtein distance between the name of an output item and name_data, None for a malformed item.
     """
-    completion = client.chat.completions.create(
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        **config
-    )
-    return json.loads(completion.choices[0].message.content)['items']
+    if not isinstance(entry_output, dict) or not isinstance(entry_output.get('name'), str) or not isinstance(entry_output.get('docstring'), str):
+        return None
+    return distance(entry_output['name'], name_data)
+
+def align_items(data, items, distance_tolerance=4):
+    """
+    Output items matched to the entries of data, in order, None for the entries without a match.
+    The alignment keeps the most matches within distance_tolerance, then the smallest total distance,
+    so a dropped or extra item does not shift the ones after it.
+    """
+    n, m = len(data), len(items)
+    costs = [[name_distance(item, entry[1]['name']) for item in items] for entry in data]
+    matches = [[costs[i][j] is not None and costs[i][j] <= distance_tolerance for j in range(m)] for i in range(n)]
+    # best[i][j]: (number of matches, -total distance) of the best alignment of data[i:] with items[j:]
+    best = [[(0, 0)] * (m + 1) for _ in range(n + 1)]
+    for i in range(n - 1, -1, -1):
+        for j in range(m - 1, -1, -1):
+            best[i][j] = max(best[i + 1][j], best[i][j + 1])
+            if matches[i][j]:
+                count, total = best[i + 1][j + 1]
+                best[i][j] = max(best[i][j], (count + 1, total - costs[i][j]))
+    aligned = [None] * n
+    i = j = 0
+    while i < n and j < m:
+        if matches[i][j] and best[i][j] == (best[i + 1][j + 1][0] + 1, best[i + 1][j + 1][1] - costs[i][j]):
+            aligned[i] = items[j]
+            i, j = i + 1, j + 1
+        elif best[i][j] == best[i + 1][j]:
+            i += 1
+        else:
+            j += 1
+    return aligned
+
+class NameChecker:
+    """
+    Checks the names of the output items as they are streamed: an item must match one of the entries
+    of data after the last matched one. Skipped entries are left to a follow-up prompt.
+    """
+    def __init__(self, data, distance_tolerance=4):
+        self.data = data
+        self.distance_tolerance = distance_tolerance
+        self.parser = ItemsParser('items')
+        self.items = []
+        self.position = 0
+
+    def __call__(self, text):
+        for entry_output in self.parser.feed(text):
+            self.items.append(entry_output)
+            candidates = [(name_distance(entry_output, entry[1]['name']), i) for i, entry in enumerate(self.data) if i >= self.position]
+            candidates = [(cost, i) for cost, i in candidates if cost is not None and cost <= self.distance_tolerance]
+            if not candidates:
+                name_output = entry_output.get('name') if isinstance(entry_output, dict) else entry_output
+                raise OutOfTolerance(f"{name_output} not detected in output")
+            self.position = min(candidates)[1] + 1
+
+async def generate_output(messages, client: LLMClient, refresh=False, make_check=None):
+    """
+    Sends messages to client, streamed through make_check() if given.
+    """
+    return await client.complete(messages, parse=lambda content: json.loads(content)['items'], refresh=refresh, make_check=make_check)
 
 def extract_json_code(content: str):
     pattern = r"```json(.*)```"
@@ -43,28 +99,39 @@ def extract_json_code(content: str):
         raise NoJsonFound(f"No json found in {content}")
     return json.loads(match.group(1))
 
-def process_prompt(prompt, export_path, data, client, config, delay=0, max_retry=3, distance_tolerance=4):
+async def process_prompt(messages, export_path, data, client: LLMClient, max_retry=3, distance_tolerance=4, make_followup=None):
     """
-    Executes generation according to prompt
+    Executes generation according to prompt.
+    Output items are aligned to data; the entries still missing are asked again with
+    make_followup(entries) (messages for these entries only), or with the same messages if not given.
     """
-    time.sleep(delay)
+    aligned = [None] * len(data)
     for k in range(max_retry):
+        missing = [i for i, entry_output in enumerate(aligned) if entry_output is None]
+        missing_data = [data[i] for i in missing]
+        if k > 0 and make_followup is not None:
+            messages = make_followup(missing_data)
+        # names are checked while the output is streamed: the generation stops at the first unexpected one
+        checkers = []
+        def make_check():
+            checkers.append(NameChecker(missing_data, distance_tolerance))
+            return checkers[-1]
+        # a cached output with missing entries must not be read again, by the next attempt or by a new run
+        refresh = k > 0 or bool(glob.glob(f"{glob.escape(export_path)}_error_*"))
         try:
-            output_json = generate_output(prompt, client, config)
-            result = {'data': data, 'output': output_json}
-            for entry_data, entry_output in zip(data, output_json):
-                name_data = entry_data[1]['name']
-                name_output = entry_output['name']
-                if distance_tolerance < distance(name_output, name_data):
-                    print(export_path)
-                    print(name_output, name_data)
-                    raise OutOfTolerance(f"{name_output} not detected in output")
+            output_json = await generate_output(messages, client, refresh=refresh, make_check=make_check)
+        except OutOfTolerance as e:
+            print(export_path)
+            print(e.message)
+            output_json = checkers[-1].items
+        for i, entry_output in zip(missing, align_items(missing_data, output_json, distance_tolerance)):
+            aligned[i] = entry_output
+        if all(entry_output is not None for entry_output in aligned):
             with open(export_path, 'w') as file:
-                json.dump(result, file, indent=4)
+                json.dump({'data': data, 'output': aligned}, file, indent=4)
             break
-        except OutOfTolerance:
-            with open(f"{export_path}_error_{k}", 'w') as file:
-                json.dump(result, file, indent=4)
+        with open(f"{export_path}_error_{k}", 'w') as file:
+            json.dump({'data': data, 'output': aligned}, file, indent=4)
 
 
 if __name__ == '__main__':
@@ -74,15 +141,22 @@ if __name__ == '__main__':
     parser.add_argument('--output', default='export/output/step_2', help='Output dataset path')
     parser.add_argument('--config-dir', default='config/step_2')
     parser.add_argument('--prompt-dir', default='config/step_2/prompts')
-    parser.add_argument('--max-workers', default=100, type=int, help='Max number of concurrent workers')
-    parser.add_argument('--mean-delay', default=10, type=int, help='Mean delay before a request is send: use this parameter to load balance')
+    parser.add_argument('--max-concurrency', default=None, type=int, help='Upper bound of concurrent requests (default: rate_limit.max_concurrency of config.yaml)')
+    parser.add_argument('--no-cache', action='store_true', help='Always send requests, without reading or writing the completion cache (e.g. to sample new outputs)')
     
     parser.add_argument('--max-retry', default=3, type=int, help='Max number of retry before having a correct json')
     parser.add_argument('--distance-tolerance', default=4, type=int, help='Tolerate Levenshtein distance between keys from json output and dataset')
 
     parser.add_argument('--chunk-overlap', default=0, type=int, help='Number of lines to prepend to chunks to give some additionnal context')
-    parser.add_argument('--chunk-size', default=500, type=int, help='Maximum number of lines contains in each chunk')
+    parser.add_argument('--max-chunk-tokens', default=16000, type=int, help='Token budget of a request: prompt and expected output')
+    parser.add_argument('--output-tokens-per-entry', default=150, type=int, help='Expected number of output tokens for each element to annotate')
+    parser.add_argument('--tokenizer', default=None, help='tiktoken model or encoding, or Hugging Face model id used to count tokens (default: the model of config.yaml)')
     parser.add_argument('--max-annotations', default=50, type=int, help='Maximum number of elements to annotate with a docstring')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the number of requests and tokens, without sending anything')
+    parser.add_argument('--prompt-layout', default='prefix', choices=['prefix', 'single'], help="'prefix': shared instructions and module context in a system message before the chunk, 'single': the template as one user message")
+    parser.add_argument('--max-active-groups', default=8, type=int, help='Number of modules whose chunks are sent at the same time')
+    parser.add_argument('--batch', action='store_true', help='Send the requests as one job of the Batch API of the endpoint (see the batch section of config.yaml)')
+    parser.add_argument('--batch-dir', default='export/batch/step_2', help='Directory of the batch requests file and of the id of the submitted batch')
     args = parser.parse_args()
 
     os.makedirs(args.output, exist_ok=True)
@@ -93,12 +167,13 @@ if __name__ == '__main__':
     with open(args.input_dataset, 'r') as file:
         input_content = json.load(file)
 
-    client = OpenAI(
-        base_url=config['base_url'],
-        api_key=os.getenv("OPENAI_API_KEY")
-    )
-    
-    to_do = []
+    # prompts are packed up to a number of tokens of the target model, see src/llm/chunking.py
+    tokenizer = args.tokenizer or config['request_config']['model']
+    count_tokens = load_token_counter(tokenizer)
+    # the chunks of a module are sent together, after a first one has filled the prefix cache of the endpoint
+    groups = []
+    planned, to_send = [], []
+    prefix_groups = []
 
     for parent, subdict in input_content.items():
         subname = parent.split('.')[-1]
@@ -109,46 +184,62 @@ if __name__ == '__main__':
             prompt_template = file.read()
         source_path = os.path.join(args.library_dir, parent.replace('.','/')+'.v')
         with open(source_path, 'r') as file:
-            source_content = file.read() + "\n\n\n" # add some extra lines to avoid issue in the while loop stop condition
-        source_lines = source_content.split('\n')
+            source_lines = file.read().split('\n')
         subdict_items = sorted(list(subdict.items()), key=lambda x: x[1]['end_line'])
-        subdict_idx = 0
-        num_lines = 0
-        start_line = 0
-        end_line = 0
-
-        splits = []
-
-        chunk_data = []
-        while end_line < len(source_lines) and subdict_idx < len(subdict_items):
-
-            if end_line - start_line >= args.chunk_size or len(chunk_data) >= args.max_annotations:
-                if chunk_data:
-                    splits.append((source_lines[start_line:end_line], chunk_data))
-        
-                start_line = end_line - args.chunk_overlap
-                chunk_data = []
-            
-            end_line += 1
-            next_entry = subdict_items[subdict_idx]
-            if next_entry[1]['end_line'] <= end_line or subdict_idx == len(subdict_items) - 1:
-                chunk_data.append(next_entry)
-                subdict_idx += 1
-
-        if chunk_data:
-            splits.append((source_lines[start_line:end_line], chunk_data))
-
-        for k, (chunk, chunk_data) in enumerate(splits):
-            chunk = "\n".join(chunk)
-            missing = "\n".join([entry[1]['name'].split('.')[-1] for entry in chunk_data])
-            prompt = prompt_template.format(**{"source":chunk, "missing":missing})
+
+        if args.prompt_layout == 'prefix':
+            shared, body = split_template(prompt_template)
+            make_messages = lambda source, names, shared=shared, body=body: prefix_messages(shared, body, source=source, missing="\n".join(names))
+            prefix_tokens = count_tokens(shared)
+        else:
+            make_messages = lambda source, names, prompt_template=prompt_template: [{"role": "user", "content": prompt_template.format(**{"source": source, "missing": "\n".join(names)})}]
+            prefix_tokens = count_tokens(prompt_template[:prompt_template.index('{source}')].format())
+
+        chunks = plan_chunks(
+            source_lines, subdict_items,
+            lambda source, names: "\n\n".join(message['content'] for message in make_messages(source, names)),
+            count_tokens, args.max_chunk_tokens, output_tokens_per_entry=args.output_tokens_per_entry,
+            max_annotations=args.max_annotations, overlap=args.chunk_overlap
+        )
+        group, prefix_group = [], []
+        for k, chunk in enumerate(chunks):
+            chunk_data = chunk.entries
+            messages = make_messages("\n".join(source_lines[chunk.start_line:chunk.end_line]), [entry[1]['name'].split('.')[-1] for entry in chunk_data])
+
+            def make_followup(entries, chunk=chunk, source_lines=source_lines, make_messages=make_messages):
+                # only the source of the missing declarations (start_line is 1-based, end_line exclusive)
+                start = max(chunk.start_line, min(entry[1]['start_line'] for entry in entries) - 1 - args.chunk_overlap)
+                end = min(chunk.end_line, max(entry[1]['end_line'] for entry in entries) - 1)
+                return make_messages("\n".join(source_lines[start:max(start + 1, end)]), [entry[1]['name'].split('.')[-1] for entry in entries])
 
             export_path = os.path.join(args.output, parent+f'#chunk_{k}')
 
+            planned.append(chunk)
             if not os.path.exists(export_path):
-                to_do.append((prompt, export_path, chunk_data))
-    delay_max = args.mean_delay*2
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:  # Adjust the number of workers as needed
-        futures = [executor.submit(process_prompt, prompt, export, entry, client, config['request_config'], delay=random.randint(0, delay_max), max_retry=args.max_retry, distance_tolerance=args.distance_tolerance) for prompt, export, entry in to_do]
-        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
-            pass
+                group.append((messages, export_path, chunk_data, make_followup))
+                prefix_group.append((prefix_tokens, chunk.prompt_tokens))
+                to_send.append(chunk)
+        if group:
+            groups.append(group)
+            prefix_groups.append(prefix_group)
+
+    print(f"Tokenizer: {tokenizer}, budget of {args.max_chunk_tokens} tokens per request")
+    print(f"Planned: {chunk_report(planned, args.max_chunk_tokens)}")
+    print(f"To send: {chunk_report(to_send, args.max_chunk_tokens)}")
+    print(f"Prefix cache ({args.prompt_layout} layout, grouped by module): {cached_prefix_report(prefix_groups)}")
+    if args.dry_run:
+        sys.exit(0)
+
+    async def main():
+        client = LLMClient.from_config(config, max_concurrency=args.max_concurrency, use_cache=not args.no_cache)
+        try:
+            if args.batch:
+                print(await BatchJob.from_config(client, config, args.batch_dir).run([messages for group in groups for messages, _, _, _ in group]))
+            await gather_grouped([
+                [lambda messages=messages, export=export, entry=entry, followup=followup: process_prompt(messages, export, entry, client, max_retry=args.max_retry, distance_tolerance=args.distance_tolerance, make_followup=followup) for messages, export, entry, followup in group]
+                for group in groups
+            ], max_active_groups=args.max_active_groups)
+        finally:
+            await client.close()
+        print(client.summary())
+    asyncio.run(main())
@@ -30,7 +30,8 @@ if __name__ == "__main__":
     result = defaultdict(dict)
     for (root,dirs,files) in os.walk(args.input, topdown=True):
         for file in files:
-            if "#chunk" in file:
+            # _error_k files are the rejected attempts of step_2
+            if "#chunk" in file and "_error_" not in file:
                 print(file)
                 filepath = os.path.join(root, file)
                 with open(filepath, 'r') as fileio:
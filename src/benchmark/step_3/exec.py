@@ -1,34 +1,31 @@
 import os
 import random
 import argparse
-import time
-import random
+import asyncio
 import json
-import concurrent.futures
 
 import yaml
-from openai import OpenAI
-from tqdm import tqdm
+
+from src.llm.client import LLMClient, gather_with_progress
+from src.llm.batch import BatchJob
 
 
-def generate_output(prompt, client, config):
+def make_messages(prompt):
+    return [
+        {"role": "user", "content": prompt}
+    ]
+
+async def generate_output(prompt, client: LLMClient):
     """
-    Sends prompt to client using config.
+    Sends prompt to client.
     """
-    completion = client.chat.completions.create(
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        **config
-    )
-    return json.loads(completion.choices[0].message.content)['query']
-
-def process_prompt(prompt, export_path, data, client, config, delay=0):
+    return await client.complete(make_messages(prompt), parse=lambda content: json.loads(content)['query'])
+
+async def process_prompt(prompt, export_path, data, client: LLMClient):
     """
     Executes generation according to prompt
     """
-    time.sleep(delay)
-    output_json = generate_output(prompt, client, config)
+    output_json = await generate_output(prompt, client)
     data['query'] = output_json
     with open(export_path, 'w') as file:
         json.dump(data, file, indent=4)
@@ -40,8 +37,10 @@ if __name__ == '__main__':
     parser.add_argument('--context-dir', default='export/output/step_1_bis/', help='Input path')
     parser.add_argument('--output', default='export/benchmark/step_3', help='Output dataset path')
     parser.add_argument('--config-dir', default='config/benchmark/step_3')
-    parser.add_argument('--max-workers', default=100, type=int, help='Max number of concurrent workers')
-    parser.add_argument('--mean-delay', default=10, type=int, help='Mean delay before a request is send: use this parameter to load balance')
+    parser.add_argument('--max-concurrency', default=None, type=int, help='Upper bound of concurrent requests (default: rate_limit.max_concurrency of config.yaml)')
+    parser.add_argument('--batch', action='store_true', help='Send the requests as one job of the Batch API of the endpoint (see the batch section of config.yaml)')
+    parser.add_argument('--batch-dir', default='export/batch/benchmark_step_3', help='Directory of the batch requests file and of the id of the submitted batch')
+    parser.add_argument('--no-cache', action='store_true', help='Always send requests, without reading or writing the completion cache (e.g. to sample new outputs)')
 
 
     args = parser.parse_args()
@@ -52,11 +51,6 @@ if __name__ == '__main__':
     prompt_path = os.path.join(args.config_dir, f'prompt.txt')
     with open(prompt_path, 'r') as file:
         prompt_template = file.read()
-    client = OpenAI(
-        base_url=config['base_url'],
-        api_key=os.getenv("OPENAI_API_KEY")
-    )
-    
     to_do = []
 
     with open(args.input, 'r') as file:
@@ -88,8 +82,15 @@ if __name__ == '__main__':
             export_path = os.path.join(args.output, benchmark_kind, f'term_{parent.replace('.', '_')}_{element_name.replace('.', '_')}.json')
             if not os.path.exists(export_path):
                 to_do.append((prompt, export_path, entry))
-    delay_max = args.mean_delay*2
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:  # Adjust the number of workers as needed
-        futures = [executor.submit(process_prompt, prompt, export, entry, client, config['request_config'], delay=random.randint(0, delay_max)) for prompt, export, entry in to_do]
-        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
-            pass
+
+    async def main():
+        client = LLMClient.from_config(config, max_concurrency=args.max_concurrency, use_cache=not args.no_cache)
+        try:
+            if args.batch:
+                print(await BatchJob.from_config(client, config, args.batch_dir).run([make_messages(prompt) for prompt, _, _ in to_do]))
+            await gather_with_progress(process_prompt(prompt, export, entry, client) for prompt, export, entry in to_do)
+        finally:
+            await client.close()
+        print(client.summary())
+    asyncio.run(main())
+
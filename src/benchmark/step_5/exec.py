@@ -8,7 +8,8 @@ from tqdm import tqdm
 from src.models.gteqwen import GteQwenEmbedding
 from src.models.mxbai import MxbaiEmbedding
 from src.models.qwen_embedding import Qwen3Embedding600m, Qwen3Embedding4b, Qwen3Embedding8b
-from src.index.cosim_index import FaissIndex
+from src.index.cosim_index import FaissIndex, load_index_config
+from src.index.hybrid_index import LexicalIndex, HybridIndex
 
 DICT_MODEL = {
     "gte_qwen": GteQwenEmbedding,
@@ -25,8 +26,14 @@ if __name__ == '__main__':
     parser.add_argument('--export-result',  default='export/benchmark/step_5')
     parser.add_argument('--model-name', default='mxbai', help="Embedding model's name")
     parser.add_argument('--device', default='cpu', help="Device for embedding model")
-    parser.add_argument('--batch-size', default=1, help="Batch size used to pre compute embedding")
+    parser.add_argument('--index-path', default='export/index/', help="Directory where the built index is saved and loaded from")
+    parser.add_argument('--index-config', default='config/index/config.yaml', help="Index build parameters")
+    parser.add_argument('--index-type', default=None, help="flat, hnsw, ivf_flat or ivf_pq (default: the one selected in --index-config)")
+    parser.add_argument('--storage', default=None, help="fp32, fp16, sq8 or pq (default: the one selected in --index-config)")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch used to pre compute embedding")
     parser.add_argument('--top-k', default=10, help="Top-k parameter use for retrieval", type=int)
+    parser.add_argument('--retrieval', default='dense', choices=['dense', 'lexical', 'hybrid'], help="Dense embeddings, BM25 only (no embedding model loaded), or both fused")
+    parser.add_argument('--fusion', default='rrf', choices=['rrf', 'weighted'], help="Rank fusion used by hybrid retrieval")
     args = parser.parse_args()
 
     with open(args.database_path, 'r') as file:
@@ -36,23 +43,35 @@ if __name__ == '__main__':
         benchmark = json.load(file)
 
     benchmark_name = args.benchmark_path.split('/')[-1]
-    model = DICT_MODEL[args.model_name](device=args.device)
-    index = FaissIndex(model, database)
+    if args.retrieval == 'lexical':
+        retrieval_name = 'bm25'
+    else:
+        model = DICT_MODEL[args.model_name](device=args.device)
+        index_config = load_index_config(args.index_config, index_type=args.index_type, storage=args.storage)
+        index = FaissIndex(model, database, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path, index_config=index_config)
+        retrieval_name = model.name()
+    if args.retrieval != 'dense':
+        lexical_index = LexicalIndex(database, index_path=args.index_path)
+        if args.retrieval == 'lexical':
+            index = lexical_index
+        else:
+            index = HybridIndex(index, lexical_index, fusion=args.fusion)
+            retrieval_name = f'hybrid_{args.fusion}_{retrieval_name}'
     to_do = []
 
     count = 0
     cumulative_rank = 0
     result = {'success':[], 'failure': []}
     result_full = {'success':[], 'failure': []}
-    for entry in tqdm(benchmark):
+    all_scores = index.query_batch([entry['query'] for entry in benchmark], top_k=args.top_k)
+    for entry, score in zip(tqdm(benchmark), all_scores):
         query = entry['query']
         constant_fqn = entry['query_constant']['fqn']
         parent = entry['query_constant']['parent']
         relative_name = entry['query_constant']['relative_name']
 
         constant = database[parent][relative_name]
-        
-        score = index.query(query, top_k=args.top_k)
+
         found = False
         new_entry = {
             "rank": -1,
@@ -80,8 +99,8 @@ if __name__ == '__main__':
     print(cumulative_rank/count)
     
     os.makedirs(args.export_result, exist_ok=True)
-    export_path = os.path.join(args.export_result, f'{model.name()}_top_{args.top_k}_{benchmark_name}')
-    export_debug_path = os.path.join(args.export_result, f'debug_{model.name()}_top_{args.top_k}_{benchmark_name}')
+    export_path = os.path.join(args.export_result, f'{retrieval_name}_top_{args.top_k}_{benchmark_name}')
+    export_debug_path = os.path.join(args.export_result, f'debug_{retrieval_name}_top_{args.top_k}_{benchmark_name}')
     with open(export_path, 'w') as file:
         json.dump(result, file, indent=4)
     with open(export_debug_path, 'w') as file:
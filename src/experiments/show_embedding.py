@@ -1,5 +1,6 @@
 import argparse
 import json
+from collections import defaultdict
 
 import matplotlib.pyplot as plt
 import torch
@@ -25,7 +26,8 @@ if __name__ == '__main__':
     parser.add_argument('--export-result',  default='export/benchmark/step_5')
     parser.add_argument('--model-name', default='mxbai', help="Embedding model's name")
     parser.add_argument('--device', default='cpu', help="Device for embedding model")
-    parser.add_argument('--batch-size', default=1, help="Batch size used to pre compute embedding")
+    parser.add_argument('--index-path', default='export/index/', help="Directory where the built index is saved and loaded from")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch used to pre compute embedding")
     parser.add_argument('--top-k', default=10, help="Top-k parameter use for retrieval", type=int)
     args = parser.parse_args()
 
@@ -37,15 +39,14 @@ if __name__ == '__main__':
 
     benchmark_name = args.benchmark_path.split('/')[-1]
     model = DICT_MODEL[args.model_name](device=args.device)
-    index = FaissIndex(model, database)
+    index = FaissIndex(model, database, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path)
 
-    for parent in index.content:
-        matrix = []
-        for element_name in index.content[parent]:
-            element = index.content[parent][element_name]
-            matrix.append(element['embedding'])
+    rows_by_parent = defaultdict(list)
+    for k, parent in enumerate(index.all_constants.strings['parent']):
+        rows_by_parent[parent].append(k)
+    for parent, rows in rows_by_parent.items():
         
-        mat = torch.stack(matrix)                   # shape (n, d)
+        mat = torch.from_numpy(index.all_embeddings[rows])   # shape (n, d)
         mat = F.normalize(mat, p=2, dim=1) 
         cosim_matrix = mat @ mat.T                        # shape (n, n)
         
@@ -53,7 +54,7 @@ if __name__ == '__main__':
         cosim_np = cosim_matrix.detach().cpu().numpy()
 
         # 3) get labels for axes
-        labels = list(index.content[parent].keys())
+        labels = [index.all_constants.strings['relative_name'][k] for k in rows]
 
         # 4) plot heatmap
         plt.figure(figsize=(8, 8))
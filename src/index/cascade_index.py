@@ -0,0 +1,78 @@
+import os
+import time
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+from src.models.base import BaseModel
+from src.index.cosim_index import CosimIndex, FaissIndex
+from src.index.embedding_store import EmbeddingStore, compute_missing_embeddings
+
+
+class CascadeIndex(CosimIndex):
+    """Two-stage retrieval: a FaissIndex built with a cheap model proposes `candidates` constants,
+    which are re-scored by the cosine similarity of a large model.
+
+    The large model only embeds the queries and the docstrings of the candidates: its document
+    embeddings are computed on first use and kept in its own EmbeddingStore under cache_path,
+    so the corpus never has to be embedded by the large model as a whole."""
+
+    def __init__(self, first_stage: FaissIndex, model: BaseModel, cache_path: str = "export/cache/", candidates=100, max_batch_tokens=8192):
+        super().__init__()
+        self.first_stage = first_stage
+        self.model = model
+        self.candidates = candidates
+        self.max_batch_tokens = max_batch_tokens
+        self.store = EmbeddingStore(os.path.join(cache_path, model.name()))
+        self.stats = {'reused': 0, 'recomputed': 0}
+
+    def query(self, query: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        return self.query_batch([query], top_k=top_k, filters=filters)[0]
+
+    def query_batch(self, queries: List[str], top_k=10, filters: Dict = None) -> List[List[Tuple[float, str, str]]]:
+        if not queries:
+            return []
+        rankings = self.first_stage.query_batch(queries, top_k=max(top_k, self.candidates), filters=filters)
+
+        # embed the docstrings of all the candidates of the batch at once, each one only the first time it is seen
+        docstrings = list(dict.fromkeys(record['docstring'] for ranking in rankings for _, record, _ in ranking))
+        keys, stats = compute_missing_embeddings(self.model, self.store, docstrings, max_batch_tokens=self.max_batch_tokens)
+        self.stats['reused'] += stats['reused']
+        self.stats['recomputed'] += stats['recomputed']
+        rows = dict(zip(docstrings, keys))
+
+        query_embeddings = self.model.generate_batch(queries, query=True, max_batch_tokens=self.max_batch_tokens).numpy()
+        result = []
+        for query_embedding, ranking in zip(query_embeddings, rankings):
+            if not ranking:
+                result.append([])
+                continue
+            vectors = self.store.get([rows[record['docstring']] for _, record, _ in ranking])
+            scores = vectors @ query_embedding / np.maximum(np.linalg.norm(vectors, axis=1), 1e-12)
+            best = np.argsort(-scores, kind='stable')[:top_k]
+            result.append([(float(scores[k]), ranking[k][1], ranking[k][2]) for k in best])
+        return result
+
+
+def evaluate_cascade(cascade: CascadeIndex, reference: CosimIndex, queries: List[str], top_k=10) -> Dict[str, float]:
+    """Recall@k of the cascade against reference (usually a flat FaissIndex of the large model),
+    the mean latency of both, and the share of the corpus the large model had to score."""
+    scored = cascade.stats['reused'] + cascade.stats['recomputed']
+    start = time.perf_counter()
+    found = cascade.query_batch(queries, top_k=top_k)
+    cascade_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+    scored = cascade.stats['reused'] + cascade.stats['recomputed'] - scored
+    start = time.perf_counter()
+    expected = reference.query_batch(queries, top_k=top_k)
+    reference_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+    hits = sum(
+        len({fqn for _, _, fqn in ranking} & {fqn for _, _, fqn in expected_ranking})
+        for ranking, expected_ranking in zip(found, expected)
+    )
+    return {
+        f"recall@{top_k}": hits / max(sum(len(ranking) for ranking in expected), 1),
+        "cascade_ms_per_query": cascade_ms,
+        "reference_ms_per_query": reference_ms,
+        "large_model_scored": scored / max(len(cascade.first_stage.all_fqn), 1),
+    }
@@ -1,98 +1,575 @@
 import os
+import json
+import hashlib
 from typing import List, Tuple, Dict
 from abc import ABC, abstractmethod
-import copy
-import hashlib
+import time
+import shutil
+import threading
 
-import torch
+import yaml
 import faiss
-from tqdm import tqdm
+import numpy as np
 
 from src.models.base import BaseModel
+from src.index.embedding_store import EmbeddingStore, compute_missing_embeddings
+from src.index.metadata import ConstantTable
+
+
+INDEX_FORMAT_VERSION = 4
+INDEX_FILE = "index.faiss"
+INDEX_METADATA_DIR = "metadata"
+INDEX_KEYS_FILE = "keys.json"
+INDEX_IDS_FILE = "ids.npy"
+INDEX_MANIFEST_FILE = "manifest.json"
+# name of the published version directory, replaced atomically by each update
+INDEX_CURRENT_FILE = "CURRENT"
+# faiss >= 1.8 can mmap the codes of flat indexes, older versions only mmap inverted lists
+MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+def database_fingerprint(content: Dict) -> str:
+    """Hash of a whole database, used to detect that a saved index is outdated."""
+    h = hashlib.sha256()
+    for parent in content:
+        for relative_name, entry in content[parent].items():
+            h.update(json.dumps([parent, relative_name, entry], sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+SQ_TYPES = {
+    'fp16': faiss.ScalarQuantizer.QT_fp16,
+    'sq8': faiss.ScalarQuantizer.QT_8bit,
+}
+IVF_TYPES = ('ivf_flat', 'ivf_pq')
+INDEX_TYPES = ('flat', 'hnsw') + IVF_TYPES
+
+def load_index_config(config_path: str, index_type: str = None, storage: str = None) -> Dict:
+    """Read the build parameters of index_type (default: the one selected in the config file)."""
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+    index_type = index_type or config['index_type']
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+    return {
+        "index_type": index_type,
+        "storage": storage or config.get('storage', 'fp32'),
+        "rerank": config.get('rerank', 0),
+        "pq": config.get('pq') or {},
+    } | (config.get(index_type) or {})
+
+def is_compressed(index_config: Dict) -> bool:
+    """Whether the index keeps lossy codes in RAM instead of the float32 vectors."""
+    return index_config.get('storage', 'fp32') != 'fp32' or index_config.get('index_type') == 'ivf_pq'
 
+def normalized_rows(matrix: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Float32 copy of some rows of matrix (possibly memory-mapped), L2 normalized."""
+    embeddings = np.ascontiguousarray(matrix[rows], dtype=np.float32)
+    faiss.normalize_L2(embeddings)
+    return embeddings
 
+def build_faiss_index(
+    matrix: np.ndarray, rows: np.ndarray, index_config: Dict, ids: np.ndarray = None, chunk_size=4096, max_train=65536
+) -> faiss.Index:
+    """Build an inner product index of the given type and storage over rows of matrix.
+    Embeddings are normalized and added by chunks, so peak memory is the index plus one chunk
+    (plus a training sample of at most max_train rows for quantized indexes).
+    Vectors are added under ids (default: their position in rows); flat and hnsw indexes are
+    wrapped in an IndexIDMap2 for that, inverted lists store the ids themselves."""
+    n, d = len(rows), matrix.shape[1]
+    if ids is None:
+        ids = np.arange(n, dtype=np.int64)
+    index_type = index_config.get('index_type', 'flat')
+    storage = index_config.get('storage', 'fp32')
+    assert storage in ('fp32', 'pq') or storage in SQ_TYPES, f"Unknown storage {storage}"
+    pq_m = index_config.get('pq', {}).get('m', 64)
+    pq_nbits = index_config.get('pq', {}).get('nbits', 8)
+    if storage == 'pq':
+        assert d % pq_m == 0, f"pq: the dimension {d} must be a multiple of m={pq_m}"
 
-def string_to_filename(s):
-    # Encode the string to bytes, then hash it
-    h = hashlib.sha256(s.encode('utf-8')).hexdigest()
-    return h
+    if index_type == 'flat':
+        if storage == 'fp32':
+            index = faiss.IndexFlatIP(d)
+        elif storage == 'pq':
+            index = faiss.IndexPQ(d, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexScalarQuantizer(d, SQ_TYPES[storage], faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'hnsw':
+        M = index_config.get('M', 32)
+        if storage == 'fp32':
+            index = faiss.IndexHNSWFlat(d, M, faiss.METRIC_INNER_PRODUCT)
+        elif storage == 'pq':
+            index = faiss.IndexHNSWPQ(d, pq_m, M, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWSQ(d, SQ_TYPES[storage], M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = index_config.get('ef_construction', 200)
+    elif index_type in IVF_TYPES:
+        # faiss needs about 39 training points per centroid
+        nlist = max(1, min(index_config.get('nlist', 1024), n // 39))
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == 'ivf_pq' or storage == 'pq':
+            m = index_config.get('m', pq_m)
+            assert d % m == 0, f"ivf_pq: the dimension {d} must be a multiple of m={m}"
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, index_config.get('nbits', pq_nbits), faiss.METRIC_INNER_PRODUCT)
+        elif storage == 'fp32':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, SQ_TYPES[storage], faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+    if not index.is_trained:
+        sample = np.sort(np.random.default_rng(0).permutation(n)[:max_train])
+        index.train(normalized_rows(matrix, rows[sample]))
+    if index_type not in IVF_TYPES:
+        index = faiss.IndexIDMap2(index)
+    for start in range(0, n, chunk_size):
+        index.add_with_ids(normalized_rows(matrix, rows[start:start + chunk_size]), ids[start:start + chunk_size])
+    set_search_params(index, index_config)
+    return index
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+def unwrap_index(index: faiss.Index) -> faiss.Index:
+    """The index under an IndexIDMap2, or index itself."""
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+def set_search_params(index: faiss.Index, index_config: Dict):
+    """Apply the search-time parameters of index_config (not all of them survive write_index)."""
+    index_type = index_config.get('index_type', 'flat')
+    if index_type == 'hnsw':
+        unwrap_index(index).hnsw.efSearch = index_config.get('ef_search', 128)
+    elif index_type in IVF_TYPES:
+        index.nprobe = index_config.get('nprobe', 16)
+
+def search_parameters(index_config: Dict, selector: faiss.IDSelector) -> faiss.SearchParameters:
+    """Search parameters restricting the search to selector, with the search-time parameters of index_config."""
+    index_type = index_config.get('index_type', 'flat')
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index_config.get('ef_search', 128))
+    if index_type in IVF_TYPES:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index_config.get('nprobe', 16))
+    return faiss.SearchParameters(sel=selector)
+
+def evaluate_index(index: "FaissIndex", reference: "FaissIndex", query_embeddings: np.ndarray, top_k=10) -> Dict[str, float]:
+    """Recall@k of index against reference (usually flat), its memory footprint and the latency of single-query searches."""
+    _, expected = reference.search(query_embeddings, top_k)
+    found = 0
+    latencies = []
+    for k in range(len(query_embeddings)):
+        start = time.perf_counter()
+        _, indices = index.search(query_embeddings[k:k+1], top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found += len(set(indices[0].tolist()) & set(expected[k].tolist()))
+    return {
+        f"recall@{top_k}": found / (top_k * len(query_embeddings)),
+        "memory_mb": index.memory_footprint() / 2**20,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
 
 class CosimIndex(ABC):
     """Abstract base class for cosim search."""
 
     @abstractmethod
-    def query(self, sentence: str, top_k=10) -> List[Tuple[float, str, str]]:
-        """Query index
+    def query(self, sentence: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        """Query index, optionally restricted by filters (see ConstantTable.select)
         return a list of score, key, label"""
         pass
 
+    @abstractmethod
+    def query_batch(self, sentences: List[str], top_k=10, filters: Dict = None) -> List[List[Tuple[float, str, str]]]:
+        """Query index with several sentences at once
+        return for each sentence, in order, a list of score, key, label"""
+        pass
+
+
+class IndexSnapshot:
+    """One published version of a FaissIndex: the faiss index, the metadata of its constants
+    and the faiss id of each constant. A snapshot is never modified once published, so a search
+    that took a reference to it keeps a consistent view while updates publish newer snapshots."""
+
+    def __init__(
+        self, index: faiss.Index, table: ConstantTable, keys: List[str], ids: np.ndarray, store: EmbeddingStore,
+        version=1, fingerprint: str = None
+    ):
+        self.index = index
+        self.table = table
+        self.keys = keys
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.store = store
+        self.version = version
+        self.fingerprint = fingerprint
+        self.next_id = int(self.ids.max()) + 1 if len(self.ids) else 0
+        self.id_rows = np.full(self.next_id, -1, dtype=np.int64)
+        self.id_rows[self.ids] = np.arange(len(self.ids))
+        self.store_rows = np.array([store.row(key) for key in keys], dtype=np.int64)
+        self._all_embeddings = None
+        self._selections = {}
+
+    @property
+    def all_embeddings(self) -> np.ndarray:
+        """Normalized embeddings of all constants, in table order (loaded on first use)."""
+        if self._all_embeddings is None:
+            self._all_embeddings = normalized_rows(self.store.matrix, self.store_rows)
+        return self._all_embeddings
+
+    def rows(self, ids: np.ndarray) -> np.ndarray:
+        """Table row of each faiss id, -1 stays -1."""
+        rows = np.full(ids.shape, -1, dtype=np.int64)
+        valid = ids >= 0
+        rows[valid] = self.id_rows[ids[valid]]
+        return rows
+
+    def selection(self, filters: Dict) -> Tuple[np.ndarray, faiss.IDSelector]:
+        """Rows matching filters and the faiss selector of their ids, cached by filter."""
+        key = json.dumps(filters, sort_keys=True)
+        if key not in self._selections:
+            rows = self.table.select(filters)
+            self._selections[key] = (rows, faiss.IDSelectorBatch(self.ids[rows]))
+        return self._selections[key]
+
 
 class FaissIndex(CosimIndex):
+    """Cosine similarity index over the docstrings of a database.
+
+    index_config selects the faiss backend (flat, hnsw, ivf_flat or ivf_pq) and its
+    parameters, see config/index/config.yaml; the default is an exact flat index.
+    With a compressed storage (fp16, sq8 or pq codes in RAM), the rerank*top_k best
+    candidates are re-scored exactly from the float32 embeddings of the memory-mapped store.
+
+    Metadata is kept as a columnar ConstantTable: lookups return lightweight record views.
+    Filtered searches restrict faiss to the selected ids; selections of at most
+    exact_search_threshold constants are searched exactly from the embedding store.
+    If index_path is given, the built index is saved there with its metadata and a version stamp;
+    later processes open it read-only through mmap instead of rebuilding it (pass content=None
+    to load without the database).
+
+    Constants can be added, updated and removed by fqn (see update, remove and apply_delta):
+    only new docstrings are embedded, and the result is published as a new IndexSnapshot.
+    Searches in flight keep the snapshot they started with; on disk, each version is a
+    directory and CURRENT is replaced atomically to point to the latest one."""
+
     def __init__(
-        self, model: BaseModel, content: Dict = None, embedding_path: str = None, cache_path: str="export/cache/", batch_size=1
+        self, model: BaseModel, content: Dict = None, cache_path: str="export/cache/", max_batch_tokens=8192,
+        index_path: str = None, index_config: Dict = None, exact_search_threshold=4096, keep_versions=2
     ):
         super().__init__()
         self.model = model
-        self.all_embeddings = []
-        self.all_fqn = []
-        self.all_constants = []
+        self.max_batch_tokens = max_batch_tokens
         self.cache_path = os.path.join(cache_path, model.name())
-        self.content = copy.deepcopy(content)
-
-        os.makedirs(self.cache_path, exist_ok=True)
-        self._compute_and_save_embedding(batch_size=batch_size)
-
-
-        for parent in self.content:
-            for relative_name in self.content[parent]:
-                entry = self.content[parent][relative_name]
-                embedding = entry["embedding"]
-                fqn = f'{parent}.{relative_name}'
-                self.all_fqn.append(fqn)
-                self.all_constants.append(entry)
-                self.all_embeddings.append(embedding.unsqueeze(0))
-
-        self.all_embeddings = torch.cat(self.all_embeddings, dim=0).to(torch.float32).numpy()
-        d = self.all_embeddings.shape[1]
-        faiss.normalize_L2(self.all_embeddings)
-        self.index = faiss.IndexFlatIP(d)
-        self.index.add(self.all_embeddings)
-
-    def _compute_and_save_embedding(self, batch_size=1):
-        to_do = []
-        for parent in self.content:
-            for relative_name in self.content[parent]:
-                element = self.content[parent][relative_name]
-                fqn = f'{parent}.{relative_name}'
-                filename = string_to_filename(fqn) + '.pt'
-                export_path = os.path.join(self.cache_path, filename)
-                if not os.path.exists(export_path):
-                    to_do.append((export_path, element))
-                else:
-                    cache_element = torch.load(export_path)
-                    element['embedding'] = cache_element['embedding']
-        to_do_chunk = list(chunks(to_do, batch_size))
-        for batch in tqdm(to_do_chunk):
-            docstring_lists = [e['docstring'] for (_, e) in batch]
-            embeddings = self.model.generate(docstring_lists)
-            for (export_path, element), embedding in zip(batch, embeddings):
-                embedding = embedding.detach().clone().cpu()
-                element['embedding'] = embedding
-                torch.save({'embedding': embedding}, export_path)
-
-    def query(self, query: str, top_k=10) -> List[Tuple[float, str, str]]:
-        query_embedding = self.model.generate(query, query=True).detach().clone().cpu().to(torch.float32)
-        distances, indices = self.index.search(query_embedding, top_k)
+        self.index_config = index_config or {"index_type": "flat"}
+        index_name = self.index_config['index_type']
+        if self.index_config.get('storage', 'fp32') != 'fp32':
+            index_name += '_' + self.index_config['storage']
+        self.index_path = os.path.join(index_path, model.name(), index_name) if index_path else None
+        self.store = EmbeddingStore(self.cache_path)
+        self.stats = {}
+        self.exact_search_threshold = exact_search_threshold
+        self.keep_versions = keep_versions
+        self.snapshot = None
+        self._update_lock = threading.Lock()
+
+        if content is None:
+            assert self.index_path, "Either content or index_path is required"
+            self.snapshot = self._load()
+            return
+
+        fingerprint = database_fingerprint(content)
+        if self.index_path and self._is_saved(fingerprint):
+            self.snapshot = self._load()
+            return
+
+        self.snapshot = self._build(content, fingerprint, max_batch_tokens=max_batch_tokens)
+        if self.index_path:
+            self.save()
+
+    def _build(self, content: Dict, fingerprint: str, max_batch_tokens=8192) -> IndexSnapshot:
+        table = ConstantTable.from_database(content)
+        keys = self._embed(table.texts('docstring'), max_batch_tokens=max_batch_tokens)
+        store_rows = np.array([self.store.row(key) for key in keys], dtype=np.int64)
+        index = build_faiss_index(self.store.matrix, store_rows, self.index_config)
+        return IndexSnapshot(index, table, keys, np.arange(len(keys)), self.store, version=self._next_version(), fingerprint=fingerprint)
+
+    def _embed(self, docstrings: List[str], max_batch_tokens=8192) -> List[str]:
+        keys, self.stats = compute_missing_embeddings(self.model, self.store, docstrings, max_batch_tokens=max_batch_tokens)
+        print(f"Embeddings reused: {self.stats['reused']}, recomputed: {self.stats['recomputed']}")
+        return keys
+
+    @property
+    def index(self) -> faiss.Index:
+        return self.snapshot.index
+
+    @property
+    def all_constants(self) -> ConstantTable:
+        return self.snapshot.table
+
+    @property
+    def all_fqn(self) -> List[str]:
+        return self.snapshot.table.fqn
+
+    @property
+    def all_keys(self) -> List[str]:
+        return self.snapshot.keys
+
+    @property
+    def all_embeddings(self) -> np.ndarray:
+        """Normalized embeddings of all constants, in table order (loaded on first use)."""
+        return self.snapshot.all_embeddings
+
+    @property
+    def store_rows(self) -> np.ndarray:
+        """Row of each constant in the embedding store, in table order."""
+        return self.snapshot.store_rows
+
+    def memory_footprint(self) -> int:
+        """Size in bytes of the faiss index (vectors or codes, plus graph or inverted lists)."""
+        return len(faiss.serialize_index(self.snapshot.index))
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k=10, filters: Dict = None, snapshot: IndexSnapshot = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search normalized query embeddings, return distances and table rows (-1 if missing) of snapshot
+        (default: the current one).
+        Compressed indexes fetch rerank*top_k candidates and re-score them exactly.
+        With filters, every query gets min(top_k, number of matching constants) results."""
+        snapshot = snapshot or self.snapshot
+        params = None
+        if filters:
+            rows, selector = snapshot.selection(filters)
+            if len(rows) <= self.exact_search_threshold:
+                return self._exact_search(snapshot, query_embeddings, rows, top_k)
+            params = search_parameters(self.index_config, selector)
+
+        rerank = self.index_config.get('rerank', 0)
+        if rerank and is_compressed(self.index_config):
+            _, candidates = snapshot.index.search(query_embeddings, top_k * rerank, params=params)
+            distances, indices = self._rerank(snapshot, query_embeddings, snapshot.rows(candidates), top_k)
+        else:
+            distances, indices = snapshot.index.search(query_embeddings, top_k, params=params)
+            indices = snapshot.rows(indices)
+
+        if filters:
+            # graph or inverted list searches can miss results under a selective filter
+            incomplete = np.flatnonzero((indices >= 0).sum(axis=1) < min(top_k, len(rows)))
+            if len(incomplete):
+                distances[incomplete], indices[incomplete] = self._exact_search(snapshot, query_embeddings[incomplete], rows, top_k)
+        return distances, indices
+
+    def _exact_search(self, snapshot: IndexSnapshot, query_embeddings: np.ndarray, rows: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute force search restricted to rows, from the full precision embeddings."""
+        distances = np.full((len(query_embeddings), top_k), -np.inf, dtype=np.float32)
+        indices = np.full((len(query_embeddings), top_k), -1, dtype=np.int64)
+        if not len(rows):
+            return distances, indices
+        scores = query_embeddings @ normalized_rows(self.store.matrix, snapshot.store_rows[rows]).T
+        best = np.argsort(-scores, axis=1)[:, :top_k]
+        distances[:, :best.shape[1]] = np.take_along_axis(scores, best, axis=1)
+        indices[:, :best.shape[1]] = rows[best]
+        return distances, indices
+
+    def _rerank(self, snapshot: IndexSnapshot, query_embeddings: np.ndarray, candidates: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        distances = np.full((len(candidates), top_k), -np.inf, dtype=np.float32)
+        indices = np.full((len(candidates), top_k), -1, dtype=np.int64)
+        matrix = self.store.matrix
+        for k, (query, rows) in enumerate(zip(query_embeddings, candidates)):
+            rows = rows[rows >= 0]
+            vectors = np.asarray(matrix[snapshot.store_rows[rows]], dtype=np.float32)
+            scores = vectors @ query / np.maximum(np.linalg.norm(vectors, axis=1), 1e-12)
+            best = np.argsort(-scores)[:top_k]
+            distances[k, :len(best)] = scores[best]
+            indices[k, :len(best)] = rows[best]
+        return distances, indices
+
+    def update(self, content: Dict) -> Dict[str, int]:
+        """Add the constants of content (a database subset, parent -> relative_name -> entry),
+        replacing those with the same fqn, and publish the result."""
+        with self._update_lock:
+            snapshot = self.snapshot
+            updated = ConstantTable.from_database(content)
+            replaced = set(updated.fqn)
+            records = [
+                (record['parent'], record['relative_name'], record)
+                for record in snapshot.table if record['fqn'] not in replaced
+            ]
+            records += [(record['parent'], record['relative_name'], record) for record in updated]
+            return self._publish(snapshot, ConstantTable.from_records(records))
+
+    def remove(self, fqns: List[str]) -> Dict[str, int]:
+        """Remove the constants with the given fqns and publish the result."""
+        with self._update_lock:
+            snapshot = self.snapshot
+            removed = set(fqns)
+            records = [
+                (record['parent'], record['relative_name'], record)
+                for record in snapshot.table if record['fqn'] not in removed
+            ]
+            return self._publish(snapshot, ConstantTable.from_records(records))
+
+    def apply_delta(self, old_content: Dict, new_content: Dict) -> Dict[str, int]:
+        """Bring an index built from old_content up to date with new_content and publish it;
+        new_content is used as is, in its order, as a fresh build would."""
+        with self._update_lock:
+            snapshot = self.snapshot
+            if old_content is not None and snapshot.fingerprint is not None:
+                assert snapshot.fingerprint == database_fingerprint(old_content), "The index was not built from the old database"
+            table = ConstantTable.from_database(new_content)
+            return self._publish(snapshot, table, fingerprint=database_fingerprint(new_content))
+
+    def _publish(self, snapshot: IndexSnapshot, table: ConstantTable, fingerprint: str = None) -> Dict[str, int]:
+        """Make table the content of the index. Constants whose fqn and docstring are unchanged keep
+        their faiss id and vector; the others are embedded (if not cached) and added under new ids.
+        The new snapshot is saved (if index_path is set) before it replaces the current one."""
+        keys = self._embed(table.texts('docstring'), max_batch_tokens=self.max_batch_tokens)
+        previous = {(fqn, key): idx for fqn, key, idx in zip(snapshot.table.fqn, snapshot.keys, snapshot.ids.tolist())}
+        ids = np.empty(len(keys), dtype=np.int64)
+        added = []
+        next_id = snapshot.next_id
+        for row, item in enumerate(zip(table.fqn, keys)):
+            if item in previous:
+                ids[row] = previous.pop(item)
+            else:
+                ids[row] = next_id
+                next_id += 1
+                added.append(row)
+        removed = np.array(sorted(previous.values()), dtype=np.int64)
+        added = np.array(added, dtype=np.int64)
+        store_rows = np.array([self.store.row(key) for key in keys], dtype=np.int64)
+
+        if self.index_config.get('index_type', 'flat') == 'hnsw' and len(removed):
+            # hnsw graphs do not support removals: rebuild the graph from the cached embeddings
+            index = build_faiss_index(self.store.matrix, store_rows, self.index_config, ids=ids)
+        else:
+            # the published index may be memory-mapped and is shared with running searches: update a private copy
+            index = faiss.deserialize_index(faiss.serialize_index(snapshot.index))
+            if len(removed):
+                index.remove_ids(removed)
+            if len(added):
+                index.add_with_ids(normalized_rows(self.store.matrix, store_rows[added]), ids[added])
+            set_search_params(index, self.index_config)
+
+        new_snapshot = IndexSnapshot(index, table, keys, ids, self.store, version=snapshot.version + 1, fingerprint=fingerprint)
+        if self.index_path:
+            new_snapshot.version = max(new_snapshot.version, self._next_version())
+            self._save(new_snapshot)
+        self.snapshot = new_snapshot
+        return {'added': len(added), 'removed': len(removed), 'version': new_snapshot.version}
+
+    def _stamp(self, fingerprint: str) -> Dict:
+        return {
+            "version": INDEX_FORMAT_VERSION,
+            "model": self.model.name(),
+            "revision": self.model.revision(),
+            "database": fingerprint,
+            "index_config": self.index_config,
+        }
+
+    def _current_version(self) -> str:
+        current_file = os.path.join(self.index_path, INDEX_CURRENT_FILE)
+        if not os.path.exists(current_file):
+            return None
+        with open(current_file, 'r') as file:
+            return file.read().strip()
+
+    def _versions(self) -> List[int]:
+        if not os.path.isdir(self.index_path):
+            return []
+        return sorted(int(name[1:]) for name in os.listdir(self.index_path) if name[0] == 'v' and name[1:].isdigit())
+
+    def _next_version(self) -> int:
+        if not self.index_path:
+            return 1
+        return max(self._versions(), default=0) + 1
+
+    def _is_saved(self, fingerprint: str) -> bool:
+        current = self._current_version()
+        if current is None:
+            return False
+        manifest_path = os.path.join(self.index_path, current, INDEX_MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        return all(manifest.get(key) == value for key, value in self._stamp(fingerprint).items())
+
+    def save(self):
+        """Save the current snapshot as a new version and publish it."""
+        self._save(self.snapshot)
+
+    def _save(self, snapshot: IndexSnapshot):
+        """Write snapshot in its own version directory, then point CURRENT to it with an atomic rename.
+        Only the keep_versions latest versions are kept: older ones may still be mapped by other
+        processes, which keep working on unlinked files until they refresh."""
+        name = f"v{snapshot.version:06d}"
+        path = os.path.join(self.index_path, name)
+        tmp_path = os.path.join(self.index_path, '.' + name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        faiss.write_index(snapshot.index, os.path.join(tmp_path, INDEX_FILE))
+        snapshot.table.save(os.path.join(tmp_path, INDEX_METADATA_DIR))
+        with open(os.path.join(tmp_path, INDEX_KEYS_FILE), 'w') as file:
+            json.dump(snapshot.keys, file)
+        np.save(os.path.join(tmp_path, INDEX_IDS_FILE), snapshot.ids)
+        manifest = self._stamp(snapshot.fingerprint) | {"ntotal": snapshot.index.ntotal, "dim": snapshot.index.d}
+        with open(os.path.join(tmp_path, INDEX_MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=4)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+        current_file = os.path.join(self.index_path, INDEX_CURRENT_FILE)
+        with open(current_file + '.tmp', 'w') as file:
+            file.write(name)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(current_file + '.tmp', current_file)
+
+        for version in self._versions()[:-self.keep_versions]:
+            if version != snapshot.version:
+                shutil.rmtree(os.path.join(self.index_path, f"v{version:06d}"), ignore_errors=True)
+
+    def _load(self) -> IndexSnapshot:
+        """Open the published version read-only through mmap, so processes on one host share its pages."""
+        current = self._current_version()
+        assert current is not None, f"No index published in {self.index_path}"
+        path = os.path.join(self.index_path, current)
+        with open(os.path.join(path, INDEX_MANIFEST_FILE), 'r') as file:
+            manifest = json.load(file)
+        assert manifest['version'] == INDEX_FORMAT_VERSION, f"Index format {manifest['version']} is not supported, rebuild the index"
+        assert manifest['model'] == self.model.name(), f"Index was built with {manifest['model']}, not {self.model.name()}"
+
+        self.index_config = manifest['index_config']
+        index = faiss.read_index(os.path.join(path, INDEX_FILE), MMAP_FLAG | faiss.IO_FLAG_READ_ONLY)
+        set_search_params(index, self.index_config)
+        table = ConstantTable.load(os.path.join(path, INDEX_METADATA_DIR))
+        with open(os.path.join(path, INDEX_KEYS_FILE), 'r') as file:
+            keys = json.load(file)
+        ids = np.load(os.path.join(path, INDEX_IDS_FILE))
+        # the version may embed docstrings added to the store by another process since it was opened
+        self.store.refresh()
+        return IndexSnapshot(index, table, keys, ids, self.store, version=int(current[1:]), fingerprint=manifest['database'])
+
+    def refresh(self) -> bool:
+        """Switch to the latest published version if another process published one."""
+        current = self._current_version() if self.index_path else None
+        if current is None or int(current[1:]) == self.snapshot.version:
+            return False
+        snapshot = self._load()
+        with self._update_lock:
+            self.snapshot = snapshot
+        return True
+
+    def query(self, query: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        return self.query_batch([query], top_k=top_k, filters=filters)[0]
+
+    def query_batch(self, queries: List[str], top_k=10, filters: Dict = None) -> List[List[Tuple[float, str, str]]]:
+        if not queries:
+            return []
+        snapshot = self.snapshot
+        query_embeddings = self.model.generate_batch(queries, query=True, max_batch_tokens=self.max_batch_tokens).numpy()
+        distances, indices = self.search(query_embeddings, top_k, filters=filters, snapshot=snapshot)
 
         result = []
-        for i, idx in enumerate(indices[0]):
-            result.append(
-                (distances[0][i], self.all_constants[idx], self.all_fqn[idx])
-            )
+        for distances_query, indices_query in zip(distances, indices):
+            result.append([
+                (distance, snapshot.table[idx], snapshot.table.fqn[idx])
+                for distance, idx in zip(distances_query, indices_query) if idx >= 0
+            ])
 
         return result
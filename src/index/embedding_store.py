@@ -0,0 +1,180 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from typing import List, Dict, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from src.models.base import BaseModel
+
+
+def embedding_key(model: BaseModel, text: str) -> str:
+    """Cache key of the embedding of text: covers the model identity, its revision and the exact text."""
+    h = hashlib.sha256()
+    for part in (model.name(), model.revision(), text):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class EmbeddingStore:
+    """Append-only on-disk store of embeddings for one model, see embedding_key for the keys.
+
+    The directory contains `embeddings.f32`, a contiguous float32 matrix of shape (n, dim)
+    opened with mmap, and `manifest.json`, which lists the key of each row.
+    Rows are written before the manifest, so an interrupted append only loses the
+    rows of the current chunk: they are truncated by the next append.
+    Several stores may be opened on the same directory (e.g. by two indexes of one model, or by
+    several processes): writes hold an exclusive lock on `.lock`, and each store reloads the
+    manifest before appending or looking for missing keys."""
+
+    DATA_FILE = "embeddings.f32"
+    MANIFEST_FILE = "manifest.json"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data_path = os.path.join(path, self.DATA_FILE)
+        self.manifest_path = os.path.join(path, self.MANIFEST_FILE)
+        self.lock_path = os.path.join(path, self.LOCK_FILE)
+        self.dim = None
+        self.keys = []
+        self.rows = {}
+        self._matrix = None
+        self._manifest_mtime = None
+
+        os.makedirs(path, exist_ok=True)
+        self.refresh()
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock of the directory, held while the data file or the manifest is written."""
+        with open(self.lock_path, 'a') as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def refresh(self):
+        """Reload the manifest if another store on the same directory updated it."""
+        if not os.path.exists(self.manifest_path):
+            return
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        if mtime == self._manifest_mtime:
+            return
+        with open(self.manifest_path, 'r') as file:
+            manifest = json.load(file)
+        self.dim = manifest['dim']
+        self.keys = manifest['keys']
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self._manifest_mtime = mtime
+        self._matrix = None
+
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def _truncate_partial_rows(self):
+        """Drop rows written by an append whose manifest update never happened (with the lock held)."""
+        if not os.path.exists(self.data_path):
+            return
+        expected = len(self.keys) * self._row_bytes() if self.dim else 0
+        if os.path.getsize(self.data_path) > expected:
+            with open(self.data_path, 'r+b') as file:
+                file.truncate(expected)
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'dim': self.dim, 'keys': self.keys}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def row(self, key: str) -> int:
+        return self.rows[key]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Read-only (n, dim) view of the whole store."""
+        if self._matrix is None:
+            if not self.keys:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            self._matrix = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(len(self.keys), self.dim))
+        return self._matrix
+
+    def get(self, keys: List[str]) -> np.ndarray:
+        """Copy the embeddings of keys into a new (len(keys), dim) array."""
+        return np.ascontiguousarray(self.matrix[[self.rows[key] for key in keys]])
+
+    def append(self, keys: List[str], embeddings: np.ndarray):
+        """Append one chunk of embeddings, then publish it in the manifest."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        assert len(keys) == embeddings.shape[0], "Number of keys and embeddings differ"
+        if not keys:
+            return
+        with self._lock():
+            self.refresh()
+            self._truncate_partial_rows()
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            assert embeddings.shape[1] == self.dim, f"Expected embeddings of dimension {self.dim}, got {embeddings.shape[1]}"
+
+            with open(self.data_path, 'ab') as file:
+                file.write(embeddings.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            for key in keys:
+                self.rows[key] = len(self.keys)
+                self.keys.append(key)
+            self._write_manifest()
+            self._matrix = None
+
+    def compact(self, keys: List[str]):
+        """Rewrite the store keeping only keys (e.g. drop embeddings of outdated docstrings)."""
+        with self._lock():
+            self.refresh()
+            keys = [key for key in dict.fromkeys(keys) if key in self.rows]
+            embeddings = self.get(keys) if keys else np.empty((0, self.dim or 0), dtype=np.float32)
+            self._matrix = None
+            tmp_path = self.data_path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(embeddings.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.data_path)
+            self.keys = keys
+            self.rows = {key: row for row, key in enumerate(keys)}
+            self._write_manifest()
+
+
+def compute_missing_embeddings(
+    model: BaseModel, store: EmbeddingStore, texts: List[str], max_batch_tokens=8192, save_every=1024
+) -> Tuple[List[str], Dict[str, int]]:
+    """Make sure the store contains an embedding for each text.
+    Only texts whose key is missing are embedded; return the key of each text and
+    the number of reused and recomputed embeddings."""
+    keys = [embedding_key(model, text) for text in texts]
+    store.refresh()
+    to_do = {}
+    for key, text in zip(keys, texts):
+        if key not in store:
+            to_do[key] = text
+    to_do = list(to_do.items())
+    # embeddings are appended to the store by chunks so that an interrupted run keeps its progress
+    for k in tqdm(range(0, len(to_do), save_every)):
+        batch = to_do[k:k + save_every]
+        embeddings = model.generate_batch([text for (_, text) in batch], max_batch_tokens=max_batch_tokens)
+        store.append([key for (key, _) in batch], embeddings.numpy())
+    stats = {'reused': len(keys) - len(to_do), 'recomputed': len(to_do)}
+    return keys, stats
@@ -0,0 +1,58 @@
+import argparse
+import json
+
+from src.models.gteqwen import GteQwenEmbedding
+from src.models.mxbai import MxbaiEmbedding
+from src.models.qwen_embedding import Qwen3Embedding600m, Qwen3Embedding4b, Qwen3Embedding8b
+from src.index.cosim_index import FaissIndex, load_index_config, evaluate_index
+
+DICT_MODEL = {
+    "gte_qwen": GteQwenEmbedding,
+    "mxbai": MxbaiEmbedding,
+    "qwen_embedding_600m": Qwen3Embedding600m,
+    "qwen_embedding_4b": Qwen3Embedding4b,
+    "qwen_embedding_8b": Qwen3Embedding8b,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare approximate or compressed indexes with the flat index on the benchmark queries.")
+    parser.add_argument('--database-path', default='export/output/step_3/result.json', help='Database path')
+    parser.add_argument('--benchmark-path', default='export/benchmark/step_4/result_outside_file.json', help='Benchmark path')
+    parser.add_argument('--config-path', default='config/index/config.yaml', help='Index build parameters')
+    parser.add_argument('--index-types', default='hnsw,ivf_flat,ivf_pq', help='Comma separated index types to evaluate, besides the exact flat index used as reference')
+    parser.add_argument('--storages', default='fp32', help='Comma separated storages to evaluate (fp32, fp16, sq8, pq)')
+    parser.add_argument('--index-path', default='export/index/', help="Directory where the built indexes are saved and loaded from")
+    parser.add_argument('--model-name', default='mxbai', help="Embedding model's name")
+    parser.add_argument('--device', default='cpu', help="Device for embedding model")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--top-k', default=10, help="Top-k parameter use for retrieval", type=int)
+    parser.add_argument('--export-result', default=None, help="Optional json file to write the report")
+    args = parser.parse_args()
+
+    with open(args.database_path, 'r') as file:
+        database = json.load(file)
+
+    with open(args.benchmark_path, 'r') as file:
+        benchmark = json.load(file)
+
+    model = DICT_MODEL[args.model_name](device=args.device)
+    queries = [entry['query'] for entry in benchmark]
+    query_embeddings = model.generate_batch(queries, query=True, max_batch_tokens=args.max_batch_tokens).numpy()
+
+    reference = FaissIndex(model, database, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path)
+    report = {'flat': evaluate_index(reference, reference, query_embeddings, top_k=args.top_k)}
+    for index_type in args.index_types.split(','):
+        for storage in args.storages.split(','):
+            if index_type == 'flat' and storage == 'fp32':
+                # already built above as the reference
+                continue
+            index_config = load_index_config(args.config_path, index_type=index_type, storage=storage)
+            index = FaissIndex(model, database, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path, index_config=index_config)
+            report[f'{index_type}_{storage}'] = evaluate_index(index, reference, query_embeddings, top_k=args.top_k)
+
+    for index_type, metrics in report.items():
+        print(f"{index_type}: " + ", ".join(f"{key}={value:.4f}" for key, value in metrics.items()))
+
+    if args.export_result:
+        with open(args.export_result, 'w') as file:
+            json.dump(report, file, indent=4)
@@ -0,0 +1,55 @@
+import argparse
+import json
+
+from src.models.gteqwen import GteQwenEmbedding
+from src.models.mxbai import MxbaiEmbedding
+from src.models.qwen_embedding import Qwen3Embedding600m, Qwen3Embedding4b, Qwen3Embedding8b
+from src.index.cosim_index import FaissIndex, load_index_config
+from src.index.cascade_index import CascadeIndex, evaluate_cascade
+
+DICT_MODEL = {
+    "gte_qwen": GteQwenEmbedding,
+    "mxbai": MxbaiEmbedding,
+    "qwen_embedding_600m": Qwen3Embedding600m,
+    "qwen_embedding_4b": Qwen3Embedding4b,
+    "qwen_embedding_8b": Qwen3Embedding8b,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare a small-model/large-model cascade with the large model alone on the benchmark queries.")
+    parser.add_argument('--database-path', default='export/output/step_3/result.json', help='Database path')
+    parser.add_argument('--benchmark-path', default='export/benchmark/step_4/result_outside_file.json', help='Benchmark path')
+    parser.add_argument('--small-model-name', default='qwen_embedding_600m', help="Model producing the candidates")
+    parser.add_argument('--large-model-name', default='qwen_embedding_8b', help="Model re-scoring the candidates")
+    parser.add_argument('--device', default='cpu', help="Device for embedding models")
+    parser.add_argument('--cache-path', default='export/cache/')
+    parser.add_argument('--index-path', default='export/index/', help="Directory where the built indexes are saved and loaded from")
+    parser.add_argument('--index-config', default='config/index/config.yaml', help="Index build parameters of the small model")
+    parser.add_argument('--candidates', default=100, type=int, help="Number of candidates re-scored by the large model")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--top-k', default=10, help="Top-k parameter use for retrieval", type=int)
+    parser.add_argument('--export-result', default=None, help="Optional json file to write the report")
+    args = parser.parse_args()
+
+    with open(args.database_path, 'r') as file:
+        database = json.load(file)
+
+    with open(args.benchmark_path, 'r') as file:
+        benchmark = json.load(file)
+    queries = [entry['query'] for entry in benchmark]
+
+    small_model = DICT_MODEL[args.small_model_name](device=args.device)
+    large_model = DICT_MODEL[args.large_model_name](device=args.device)
+    small_index = FaissIndex(
+        small_model, database, cache_path=args.cache_path, max_batch_tokens=args.max_batch_tokens,
+        index_path=args.index_path, index_config=load_index_config(args.index_config)
+    )
+    cascade = CascadeIndex(small_index, large_model, cache_path=args.cache_path, candidates=args.candidates, max_batch_tokens=args.max_batch_tokens)
+
+    reference = FaissIndex(large_model, database, cache_path=args.cache_path, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path)
+    report = evaluate_cascade(cascade, reference, queries, top_k=args.top_k)
+    print(", ".join(f"{key}={value:.4f}" for key, value in report.items()))
+
+    if args.export_result:
+        with open(args.export_result, 'w') as file:
+            json.dump(report, file, indent=4)
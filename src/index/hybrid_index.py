@@ -0,0 +1,167 @@
+import os
+import re
+import json
+from typing import List, Tuple, Dict
+
+import numpy as np
+import bm25s
+
+from src.index.cosim_index import CosimIndex, FaissIndex, database_fingerprint, INDEX_MANIFEST_FILE, INDEX_METADATA_DIR
+from src.index.metadata import ConstantTable
+
+
+LEXICAL_FORMAT_VERSION = 1
+BM25_DIR = "bm25"
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_']+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words and identifiers; identifiers with underscores also yield their parts,
+    so that `big_ord` matches both `big_ord` and `big`."""
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text):
+        word = word.lower()
+        tokens.append(word)
+        if '_' in word:
+            tokens += [part for part in word.split('_') if part]
+    return tokens
+
+
+class LexicalIndex(CosimIndex):
+    """BM25 index over the docstrings, fullnames and names of a database.
+
+    It does not need any embedding model, so it can answer queries on its own.
+    If index_path is given, the BM25 index is saved there and reloaded (memory-mapped) while
+    the database is unchanged; pass content=None to load it without the database."""
+
+    def __init__(self, content: Dict = None, index_path: str = None):
+        super().__init__()
+        self.index_path = os.path.join(index_path, BM25_DIR) if index_path else None
+
+        if content is None:
+            assert self.index_path, "Either content or index_path is required"
+            self._load()
+            return
+
+        fingerprint = database_fingerprint(content)
+        if self.index_path and self._is_saved(fingerprint):
+            self._load()
+            return
+
+        self.all_constants = ConstantTable.from_database(content)
+        self.all_fqn = self.all_constants.fqn
+        corpus = [
+            tokenize(f"{record['name']} {record['fullname']} {record['docstring']}")
+            for record in self.all_constants
+        ]
+        self.retriever = bm25s.BM25()
+        self.retriever.index(corpus, show_progress=False)
+        if self.index_path:
+            self.save(fingerprint)
+
+    def _stamp(self, fingerprint: str) -> Dict:
+        return {"version": LEXICAL_FORMAT_VERSION, "database": fingerprint}
+
+    def _is_saved(self, fingerprint: str) -> bool:
+        manifest_path = os.path.join(self.index_path, INDEX_MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        return manifest == self._stamp(fingerprint)
+
+    def save(self, fingerprint: str):
+        os.makedirs(self.index_path, exist_ok=True)
+        manifest_file = os.path.join(self.index_path, INDEX_MANIFEST_FILE)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        self.retriever.save(self.index_path, show_progress=False)
+        self.all_constants.save(os.path.join(self.index_path, INDEX_METADATA_DIR))
+        with open(manifest_file, 'w') as file:
+            json.dump(self._stamp(fingerprint), file, indent=4)
+
+    def _load(self):
+        with open(os.path.join(self.index_path, INDEX_MANIFEST_FILE), 'r') as file:
+            manifest = json.load(file)
+        assert manifest['version'] == LEXICAL_FORMAT_VERSION, f"Lexical index format {manifest['version']} is not supported, rebuild the index"
+        self.retriever = bm25s.BM25.load(self.index_path, mmap=True, show_progress=False)
+        self.all_constants = ConstantTable.load(os.path.join(self.index_path, INDEX_METADATA_DIR))
+        self.all_fqn = self.all_constants.fqn
+
+    def search(self, queries: List[str], top_k=10, filters: Dict = None) -> Tuple[List[List[float]], List[List[int]]]:
+        """Scores and ids of the top_k documents of each query; documents without any matching token,
+        or not matching filters, are dropped."""
+        top_k = min(top_k, len(self.all_fqn))
+        weight_mask = None
+        if filters:
+            weight_mask = np.zeros(len(self.all_fqn), dtype=np.float32)
+            weight_mask[self.all_constants.select(filters)] = 1.
+        indices, scores = self.retriever.retrieve(
+            [tokenize(query) for query in queries], k=top_k, show_progress=False, weight_mask=weight_mask
+        )
+        result_scores, result_indices = [], []
+        for scores_query, indices_query in zip(scores, indices):
+            keep = scores_query > 0
+            result_scores.append(scores_query[keep].tolist())
+            result_indices.append(indices_query[keep].tolist())
+        return result_scores, result_indices
+
+    def query(self, query: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        return self.query_batch([query], top_k=top_k, filters=filters)[0]
+
+    def query_batch(self, queries: List[str], top_k=10, filters: Dict = None) -> List[List[Tuple[float, str, str]]]:
+        if not queries:
+            return []
+        scores, indices = self.search(queries, top_k, filters=filters)
+        return [
+            [(score, self.all_constants[idx], self.all_fqn[idx]) for score, idx in zip(scores_query, indices_query)]
+            for scores_query, indices_query in zip(scores, indices)
+        ]
+
+
+class HybridIndex(CosimIndex):
+    """Fuse the rankings of a dense FaissIndex and a LexicalIndex built on the same database.
+
+    fusion is either 'rrf' (reciprocal rank fusion, sum of 1 / (rrf_k + rank)) or 'weighted'
+    (min-max normalized scores, weight for dense and 1 - weight for lexical); each ranking
+    contributes its `candidates` best documents."""
+
+    def __init__(self, dense: FaissIndex, lexical: LexicalIndex, fusion='rrf', rrf_k=60, weight=0.5, candidates=100):
+        super().__init__()
+        assert fusion in ('rrf', 'weighted'), f"Unknown fusion {fusion}"
+        self.dense = dense
+        self.lexical = lexical
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.weight = weight
+        self.candidates = candidates
+
+    def _fuse(self, rankings: List[Tuple[float, List[Tuple[float, str, str]]]]) -> Dict[str, float]:
+        fused = {}
+        for weight, ranking in rankings:
+            if not ranking:
+                continue
+            if self.fusion == 'rrf':
+                for rank, (_, _, fqn) in enumerate(ranking):
+                    fused[fqn] = fused.get(fqn, 0.) + 1. / (self.rrf_k + rank + 1)
+            else:
+                scores = [float(score) for score, _, _ in ranking]
+                low, high = min(scores), max(scores)
+                for score, (_, _, fqn) in zip(scores, ranking):
+                    normalized = (score - low) / (high - low) if high > low else 1.
+                    fused[fqn] = fused.get(fqn, 0.) + weight * normalized
+        return fused
+
+    def query(self, query: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        return self.query_batch([query], top_k=top_k, filters=filters)[0]
+
+    def query_batch(self, queries: List[str], top_k=10, filters: Dict = None) -> List[List[Tuple[float, str, str]]]:
+        candidates = max(top_k, self.candidates)
+        dense_results = self.dense.query_batch(queries, top_k=candidates, filters=filters)
+        lexical_results = self.lexical.query_batch(queries, top_k=candidates, filters=filters)
+        result = []
+        for dense_ranking, lexical_ranking in zip(dense_results, lexical_results):
+            records = {fqn: record for _, record, fqn in lexical_ranking + dense_ranking}
+            fused = self._fuse([(self.weight, dense_ranking), (1 - self.weight, lexical_ranking)])
+            best = sorted(fused.items(), key=lambda x: -x[1])[:top_k]
+            result.append([(score, records[fqn], fqn) for fqn, score in best])
+        return result
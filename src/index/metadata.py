@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+from typing import Dict, List, Iterable, Tuple
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class ConstantRecord(Mapping):
+    """Read-only view of one constant of a ConstantTable, used like the entry dict of the database."""
+
+    __slots__ = ('table', 'idx')
+
+    def __init__(self, table: "ConstantTable", idx: int):
+        self.table = table
+        self.idx = idx
+
+    def __getitem__(self, key: str):
+        return self.table.field(self.idx, key)
+
+    def __iter__(self):
+        return iter(ConstantTable.FIELDS)
+
+    def __len__(self) -> int:
+        return len(ConstantTable.FIELDS)
+
+    def __repr__(self) -> str:
+        return f"ConstantRecord({self.table.fqn[self.idx]})"
+
+
+class ConstantTable:
+    """Columnar metadata of the constants of a database.
+
+    Short strings (fqn, parent, name, kind...) are interned python lists, line numbers are
+    an int32 array, and docstrings/fullnames are packed in a single utf-8 blob addressed by offsets."""
+
+    TEXT_FIELDS = ('docstring', 'fullname')
+    STRING_FIELDS = ('fqn', 'parent', 'relative_name', 'name', 'kind')
+    INT_FIELDS = ('start_line', 'end_line')
+    FIELDS = STRING_FIELDS + TEXT_FIELDS + INT_FIELDS
+
+    STRINGS_FILE = "strings.json"
+    INTS_FILE = "ints.npy"
+    OFFSETS_FILE = "offsets.npy"
+    BLOB_FILE = "texts.bin"
+
+    def __init__(self, strings: Dict[str, List[str]], ints: np.ndarray, offsets: np.ndarray, blob):
+        self.strings = strings
+        self.ints = ints
+        self.offsets = offsets
+        self.blob = blob
+        self.fqn = strings['fqn']
+
+    @classmethod
+    def from_database(cls, content: Dict) -> "ConstantTable":
+        """Build the table in one pass over a step_3 database, without copying its entries."""
+        return cls.from_records(
+            (parent, relative_name, entry) for parent in content for relative_name, entry in content[parent].items()
+        )
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[str, str, Mapping]]) -> "ConstantTable":
+        """Build the table from (parent, relative_name, entry) triples; entry may be a database
+        entry or a ConstantRecord of another table."""
+        strings = {key: [] for key in cls.STRING_FIELDS}
+        ints = []
+        offsets = [0]
+        blob = bytearray()
+        for parent, relative_name, entry in records:
+            values = {
+                'fqn': f'{parent}.{relative_name}',
+                'parent': parent,
+                'relative_name': relative_name,
+                'name': entry.get('name', relative_name),
+                'kind': entry.get('kind', ''),
+            }
+            for key in cls.STRING_FIELDS:
+                strings[key].append(sys.intern(values[key]))
+            ints.append([entry.get(key, -1) for key in cls.INT_FIELDS])
+            for key in cls.TEXT_FIELDS:
+                blob += entry.get(key, '').encode('utf-8')
+                offsets.append(len(blob))
+        ints = np.array(ints, dtype=np.int32).reshape(-1, len(cls.INT_FIELDS))
+        return cls(strings, ints, np.array(offsets, dtype=np.int64), bytes(blob))
+
+    def __len__(self) -> int:
+        return len(self.fqn)
+
+    def __getitem__(self, idx: int) -> ConstantRecord:
+        return ConstantRecord(self, int(idx))
+
+    def __iter__(self):
+        return (ConstantRecord(self, idx) for idx in range(len(self)))
+
+    def field(self, idx: int, key: str):
+        if key in self.strings:
+            return self.strings[key][idx]
+        if key in self.TEXT_FIELDS:
+            j = idx * len(self.TEXT_FIELDS) + self.TEXT_FIELDS.index(key)
+            return bytes(self.blob[self.offsets[j]:self.offsets[j + 1]]).decode('utf-8')
+        if key in self.INT_FIELDS:
+            return int(self.ints[idx, self.INT_FIELDS.index(key)])
+        raise KeyError(key)
+
+    def texts(self, key: str) -> List[str]:
+        """All the values of a text field, in table order."""
+        return [self.field(idx, key) for idx in range(len(self))]
+
+    def select(self, filters: Dict) -> np.ndarray:
+        """Sorted ids of the constants matching all the given filters:
+        - module_prefix: fqn equal to the prefix or below it (e.g. "algebra" or "algebra.ssralg.GRing")
+        - kinds: kinds to keep (e.g. ["Lemma", "Theorem"]), exclude_kinds: kinds to drop
+        - files: parents to keep (e.g. ["algebra.ssralg"])"""
+        mask = np.ones(len(self), dtype=bool)
+        prefix = filters.get('module_prefix')
+        if prefix:
+            mask &= np.array([fqn == prefix or fqn.startswith(prefix + '.') for fqn in self.fqn], dtype=bool)
+        if filters.get('kinds'):
+            kinds = set(filters['kinds'])
+            mask &= np.array([kind in kinds for kind in self.strings['kind']], dtype=bool)
+        if filters.get('exclude_kinds'):
+            kinds = set(filters['exclude_kinds'])
+            mask &= np.array([kind not in kinds for kind in self.strings['kind']], dtype=bool)
+        if filters.get('files'):
+            files = set(filters['files'])
+            mask &= np.array([parent in files for parent in self.strings['parent']], dtype=bool)
+        return np.flatnonzero(mask).astype(np.int64)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, self.STRINGS_FILE), 'w') as file:
+            json.dump(self.strings, file)
+        np.save(os.path.join(path, self.INTS_FILE), self.ints)
+        np.save(os.path.join(path, self.OFFSETS_FILE), self.offsets)
+        with open(os.path.join(path, self.BLOB_FILE), 'wb') as file:
+            file.write(bytes(self.blob))
+
+    @classmethod
+    def load(cls, path: str) -> "ConstantTable":
+        """Load a saved table; the arrays and the text blob are memory-mapped."""
+        with open(os.path.join(path, cls.STRINGS_FILE), 'r') as file:
+            strings = {key: [sys.intern(value) for value in values] for key, values in json.load(file).items()}
+        ints = np.load(os.path.join(path, cls.INTS_FILE), mmap_mode='r')
+        offsets = np.load(os.path.join(path, cls.OFFSETS_FILE), mmap_mode='r')
+        blob_path = os.path.join(path, cls.BLOB_FILE)
+        blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) else b''
+        return cls(strings, ints, offsets, blob)
@@ -0,0 +1,79 @@
+import os
+import argparse
+import json
+from typing import Dict
+
+from src.models.gteqwen import GteQwenEmbedding
+from src.models.mxbai import MxbaiEmbedding
+from src.models.qwen_embedding import Qwen3Embedding600m, Qwen3Embedding4b, Qwen3Embedding8b
+from src.index.embedding_store import EmbeddingStore, compute_missing_embeddings
+from src.index.cosim_index import FaissIndex, load_index_config
+
+DICT_MODEL = {
+    "gte_qwen": GteQwenEmbedding,
+    "mxbai": MxbaiEmbedding,
+    "qwen_embedding_600m": Qwen3Embedding600m,
+    "qwen_embedding_4b": Qwen3Embedding4b,
+    "qwen_embedding_8b": Qwen3Embedding8b,
+}
+
+def diff_databases(old: Dict, new: Dict) -> Dict[str, list]:
+    """Compare the docstrings of two step_3 databases, fqn by fqn."""
+    def docstrings(database):
+        return {f'{parent}.{relative_name}': entry['docstring'] for parent in database for relative_name, entry in database[parent].items()}
+    old_docstrings, new_docstrings = docstrings(old), docstrings(new)
+    result = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
+    for fqn, docstring in new_docstrings.items():
+        if fqn not in old_docstrings:
+            result['added'].append(fqn)
+        elif old_docstrings[fqn] != docstring:
+            result['changed'].append(fqn)
+        else:
+            result['unchanged'].append(fqn)
+    result['removed'] = [fqn for fqn in old_docstrings if fqn not in new_docstrings]
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the embedding cache of a model after docstrings changed, and optionally a saved index.")
+    parser.add_argument('--database-path', default='export/output/step_3/result.json', help='New database path')
+    parser.add_argument('--old-database-path', default=None, help='Previous database path, used to report which docstrings changed')
+    parser.add_argument('--cache-path', default='export/cache/')
+    parser.add_argument('--model-name', default='mxbai', help="Embedding model's name")
+    parser.add_argument('--device', default='cpu', help="Device for embedding model")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--compact', action='store_true', help="Drop cached embeddings not used by the new database")
+    parser.add_argument('--index-path', default=None, help="If set, apply the delta to the index saved there and publish a new version")
+    parser.add_argument('--index-config', default='config/index/config.yaml', help="Index build parameters")
+    parser.add_argument('--index-type', default=None, help="flat, hnsw, ivf_flat or ivf_pq (default: the one selected in --index-config)")
+    parser.add_argument('--storage', default=None, help="fp32, fp16, sq8 or pq (default: the one selected in --index-config)")
+    args = parser.parse_args()
+
+    with open(args.database_path, 'r') as file:
+        database = json.load(file)
+
+    old_database = None
+    if args.old_database_path:
+        with open(args.old_database_path, 'r') as file:
+            old_database = json.load(file)
+        diff = diff_databases(old_database, database)
+        for key, value in diff.items():
+            print(f"{key}: {len(value)}")
+
+    model = DICT_MODEL[args.model_name](device=args.device)
+    store = EmbeddingStore(os.path.join(args.cache_path, model.name()))
+    docstrings = [entry['docstring'] for parent in database for entry in database[parent].values()]
+    keys, stats = compute_missing_embeddings(model, store, docstrings, max_batch_tokens=args.max_batch_tokens)
+    print(f"Embeddings reused: {stats['reused']}, recomputed: {stats['recomputed']}")
+
+    if args.index_path:
+        index_config = load_index_config(args.index_config, index_type=args.index_type, storage=args.storage)
+        index = FaissIndex(
+            model, cache_path=args.cache_path, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path, index_config=index_config
+        )
+        result = index.apply_delta(old_database, database)
+        print(f"Published index version {result['version']}: {result['added']} added, {result['removed']} removed")
+
+    if args.compact:
+        before = len(store)
+        store.compact(keys)
+        print(f"Compacted cache from {before} to {len(store)} embeddings")
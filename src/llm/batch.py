@@ -0,0 +1,108 @@
+import os
+import json
+import asyncio
+from typing import Dict, List
+
+from openai import AsyncOpenAI
+
+from src.llm.client import LLMClient
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchJob:
+    """Send the requests of a step through an OpenAI-compatible Batch API instead of one by one.
+
+    The requests not cached yet are written to `requests.jsonl` in work_dir, uploaded, and
+    submitted as one batch; the batch id is kept in `batch.json`, so an interrupted run polls
+    the same batch again instead of submitting a new one. Once the batch is done, its results are
+    given to the client with LLMClient.prefetch: the step then runs as usual, with the same checks
+    and output files, and only the requests that failed or were rejected are sent again one by one.
+    base_url selects another endpoint for batches (e.g. src/server/batch_server.py)."""
+
+    STATE_FILE = "batch.json"
+    REQUESTS_FILE = "requests.jsonl"
+
+    def __init__(self, client: LLMClient, work_dir: str, base_url: str = None, poll_interval=30., completion_window="24h"):
+        self.client = client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.api = AsyncOpenAI(base_url=base_url, api_key=os.getenv("OPENAI_API_KEY")) if base_url else client.client
+        self.state_path = os.path.join(work_dir, self.STATE_FILE)
+
+    @classmethod
+    def from_config(cls, client: LLMClient, config: Dict, work_dir: str) -> "BatchJob":
+        """Job for the optional `batch` section of a step config.yaml (base_url, poll_interval, completion_window)."""
+        return cls(client, work_dir, **(config.get('batch') or {}))
+
+    def _pending(self, requests: List[List[Dict]]) -> Dict[str, List[Dict]]:
+        pending = {}
+        for messages in requests:
+            key = self.client.key(messages)
+            if not (self.client.cache and key in self.client.cache):
+                pending[key] = messages
+        return pending
+
+    async def _submit(self, pending: Dict[str, List[Dict]]) -> str:
+        os.makedirs(self.work_dir, exist_ok=True)
+        requests_path = os.path.join(self.work_dir, self.REQUESTS_FILE)
+        with open(requests_path, 'w') as file:
+            for key, messages in pending.items():
+                body = dict(self.client.request_config, messages=messages)
+                file.write(json.dumps({"custom_id": key, "method": "POST", "url": "/v1/chat/completions", "body": body}) + '\n')
+        with open(requests_path, 'rb') as file:
+            input_file = await self.api.files.create(file=file, purpose="batch")
+        batch = await self.api.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window=self.completion_window
+        )
+        with open(self.state_path, 'w') as file:
+            json.dump({"batch_id": batch.id, "keys": sorted(pending)}, file)
+        print(f"Submitted batch {batch.id} with {len(pending)} requests")
+        return batch.id
+
+    async def _resume(self, pending: Dict[str, List[Dict]]) -> str:
+        """Id of the batch submitted by a previous run for the same requests, if any."""
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, 'r') as file:
+            state = json.load(file)
+        if not set(pending) <= set(state['keys']):
+            return None
+        batch = await self.api.batches.retrieve(state['batch_id'])
+        if batch.status in ('failed', 'expired', 'cancelled'):
+            return None
+        print(f"Resuming batch {batch.id} ({batch.status})")
+        return batch.id
+
+    async def run(self, requests: List[List[Dict]]) -> Dict[str, int]:
+        """Run the requests (lists of messages) not cached yet as a batch, prefetch their results
+        into the client and return the number of submitted, completed and failed requests."""
+        pending = self._pending(requests)
+        stats = {'submitted': len(pending), 'completed': 0, 'failed': 0}
+        if not pending:
+            return stats
+        batch_id = await self._resume(pending) or await self._submit(pending)
+        while True:
+            batch = await self.api.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            if counts is not None:
+                print(f"Batch {batch_id}: {batch.status}, {counts.completed}/{counts.total} completed, {counts.failed} failed")
+            if batch.status in TERMINAL_STATUSES:
+                break
+            await asyncio.sleep(self.poll_interval)
+
+        if batch.output_file_id:
+            content = await self.api.files.content(batch.output_file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200 or result['custom_id'] not in pending:
+                    continue
+                self.client.prefetch(result['custom_id'], response['body']['choices'][0]['message']['content'])
+                stats['completed'] += 1
+        # batch.json is kept: a run interrupted before the outputs are written downloads the results again
+        stats['failed'] = stats['submitted'] - stats['completed']
+        return stats
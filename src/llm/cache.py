@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from typing import Dict, List, Optional
+
+
+def completion_key(base_url: str, request_config: Dict, messages: List[Dict]) -> str:
+    """Cache key of a chat completion: the endpoint, the model, the other request parameters and the messages."""
+    payload = [base_url, request_config.get('model'), request_config, messages]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """Completions kept in a sqlite file, by completion_key, shared by the steps calling an LLM
+    (several processes may use the same file).
+
+    When the stored completions exceed max_size_mb, the least recently used ones are evicted.
+    The total size is kept up to date from the inserted and deleted rows, and is only summed over
+    the table again (to include the writes of other processes) when it goes over the budget."""
+
+    def __init__(self, path: str = "export/cache/llm.sqlite", max_size_mb: float = 1024):
+        self.path = path
+        self.max_size = int(max_size_mb * 2 ** 20)
+        self.stats = {'hits': 0, 'misses': 0}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self.total_size = self._sum_size()
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "CompletionCache":
+        """Cache of the `cache` section of a step config.yaml (path and max_size_mb)."""
+        return cls(**(config.get('cache') or {}))
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.connection.execute("SELECT content FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.connection.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def __contains__(self, key: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM completions WHERE key = ?", (key,)).fetchone() is not None
+
+    def _sum_size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def put(self, key: str, content: str):
+        size = len(content.encode('utf-8'))
+        row = self.connection.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO completions (key, content, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, content, size, time.time())
+        )
+        self.total_size += size - (row[0] if row else 0)
+        if self.total_size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        self.total_size = self._sum_size()
+        if self.total_size <= self.max_size:
+            return
+        excess = self.total_size - self.max_size
+        freed = 0
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM completions ORDER BY last_used"):
+            if freed >= excess:
+                break
+            keys.append((key,))
+            freed += size
+        self.connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+        self.total_size -= freed
+
+    def close(self):
+        self.connection.close()
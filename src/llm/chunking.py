@@ -0,0 +1,68 @@
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+
+class Chunk(NamedTuple):
+    start_line: int          # first line of the source in the prompt (0-based)
+    end_line: int            # line after the last one (0-based, exclusive)
+    entries: List[Tuple[str, Dict]]
+    prompt: str
+    prompt_tokens: int
+    output_tokens: int
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+
+def plan_chunks(source_lines: List[str], entries: List[Tuple[str, Dict]], render: Callable[[str, List[str]], str],
+                count_tokens: Callable[[str], int], max_tokens: int, output_tokens_per_entry=150, max_annotations=50,
+                overlap=0) -> List[Chunk]:
+    """Pack the entries of a source file (sorted by end_line) into as few prompts as possible.
+
+    A chunk ends after a declaration and the blank lines that follow it (its end_line), so a
+    declaration is never split. Entries are added while the prompt, render(source, names), plus
+    output_tokens_per_entry for each entry fits in max_tokens, and until max_annotations entries;
+    a single declaration larger than the budget gets its own chunk. overlap lines before a chunk
+    are prepended as context. The tokens of a prompt are estimated as the sum of the tokens of its
+    parts while packing, and counted exactly on the rendered prompt of each chunk."""
+    def names(chunk_entries):
+        return [entry['name'].split('.')[-1] for _, entry in chunk_entries]
+
+    def close(start, end, chunk_entries):
+        prompt = render("\n".join(source_lines[start:end]), names(chunk_entries))
+        chunks.append(Chunk(start, end, chunk_entries, prompt, count_tokens(prompt), output_tokens_per_entry * len(chunk_entries)))
+
+    base_tokens = count_tokens(render("", []))
+    chunks = []
+    current = []
+    start = cut = 0
+    tokens = base_tokens
+    for name, entry in entries:
+        # the source up to this declaration (and its trailing blank lines), from the previous one
+        previous_cut, cut = cut, max(cut, min(len(source_lines), entry['end_line'] - 1))
+        cost = count_tokens("\n".join(source_lines[previous_cut:cut])) + count_tokens(names([(name, entry)])[0]) + 2 \
+            + output_tokens_per_entry
+        if current and (tokens + cost > max_tokens or len(current) >= max_annotations):
+            close(start, previous_cut, current)
+            start = max(0, previous_cut - overlap)
+            current = []
+            tokens = base_tokens + count_tokens("\n".join(source_lines[start:previous_cut]))
+        current.append((name, entry))
+        tokens += cost
+    if current:
+        close(start, cut, current)
+    return chunks
+
+
+def chunk_report(chunks: List[Chunk], max_tokens: int) -> Dict:
+    """Number of requests and tokens of planned chunks, to review before sending anything."""
+    tokens = [chunk.tokens for chunk in chunks]
+    return {
+        "requests": len(chunks),
+        "entries": sum(len(chunk.entries) for chunk in chunks),
+        "prompt_tokens": sum(chunk.prompt_tokens for chunk in chunks),
+        "expected_output_tokens": sum(chunk.output_tokens for chunk in chunks),
+        "mean_tokens_per_request": sum(tokens) / max(len(tokens), 1),
+        "max_tokens_per_request": max(tokens, default=0),
+        "over_budget": sum(token > max_tokens for token in tokens),
+    }
@@ -0,0 +1,315 @@
+import os
+import time
+import random
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple
+
+import openai
+from openai import AsyncOpenAI
+from tqdm import tqdm
+
+from src.llm.cache import CompletionCache, completion_key
+
+# defaults of the `rate_limit` section of the config.yaml files of the steps calling an LLM
+DEFAULT_RATE_LIMIT = {
+    "requests_per_minute": 500,
+    "tokens_per_minute": 1_000_000,
+    "max_concurrency": 100,
+    "min_concurrency": 1,
+    "initial_concurrency": 8,
+    "expected_output_tokens": 1024,
+    "max_retries": 6,
+    "backoff_base": 1.,
+    "backoff_max": 60.,
+    "timeout": 600.,
+}
+
+
+class TokenBucket:
+    """Allow `rate_per_minute` units per minute, with bursts of at most one minute worth of units."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        """Wait until amount units are available and take them (a request larger than the
+        capacity waits for a full bucket)."""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate)
+                self._refill()
+            self.level -= amount
+
+    def adjust(self, amount: float):
+        """Give back (amount < 0) or take more units once the actual cost of a request is known."""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class AIMDLimiter:
+    """Concurrency limit with additive increase (one more slot after `limit` successes) and
+    multiplicative decrease (halved on a 429 or a timeout, at most once per round trip)."""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.last_decrease = 0.
+
+    async def acquire(self) -> float:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started: float, success: bool, overloaded: bool):
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                # requests sent before the previous decrease do not decrease the limit again
+                if started >= self.last_decrease:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+            elif success:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def _is_overload(e: Exception) -> bool:
+    return isinstance(e, (openai.RateLimitError, openai.APITimeoutError, asyncio.TimeoutError))
+
+
+def _is_transient(e: Exception) -> bool:
+    return _is_overload(e) or isinstance(e, (openai.APIConnectionError, openai.InternalServerError)) or \
+        (isinstance(e, openai.APIStatusError) and e.status_code in (408, 409, 425))
+
+
+def _retry_after(e: Exception) -> float:
+    response = getattr(e, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return 0.
+
+
+class StreamAborted(Exception):
+    """A check of a streamed completion raised error after content was received."""
+
+    def __init__(self, error: Exception, content: str):
+        super().__init__(str(error))
+        self.error = error
+        self.content = content
+
+
+class LLMClient:
+    """Asynchronous chat completions shared by the steps calling an LLM.
+
+    Requests wait for the request and token per minute buckets (the tokens of a request are
+    estimated from its characters and the expected output, then corrected with the usage of the
+    response), and for a slot of the AIMD concurrency limit. Rate limits (429), timeouts, connection
+    and server errors are retried with exponential backoff and jitter (or the Retry-After delay).
+    With a CompletionCache, a request already answered is not sent again; completions obtained
+    otherwise (e.g. by a BatchJob, see src/llm/batch.py) are given with prefetch."""
+
+    def __init__(self, base_url: str, request_config: Dict, rate_limit: Dict = None, api_key: str = None, client=None,
+                 cache: CompletionCache = None):
+        self.base_url = base_url
+        self.request_config = request_config
+        self.cache = cache
+        self.rate_limit = DEFAULT_RATE_LIMIT | (rate_limit or {})
+        self.client = client or AsyncOpenAI(
+            base_url=base_url, api_key=api_key or os.getenv("OPENAI_API_KEY"), max_retries=0, timeout=self.rate_limit['timeout']
+        )
+        self.requests = TokenBucket(self.rate_limit['requests_per_minute'])
+        self.tokens = TokenBucket(self.rate_limit['tokens_per_minute'])
+        self.concurrency = AIMDLimiter(
+            self.rate_limit['initial_concurrency'], self.rate_limit['min_concurrency'], self.rate_limit['max_concurrency']
+        )
+        self.prefetched = {}
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0, 'aborted': 0, 'rejected_prefetched': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict, max_concurrency: int = None, use_cache=True) -> "LLMClient":
+        """Client for a step config.yaml: base_url, request_config and optional rate_limit and cache sections.
+        Disable the cache (use_cache=False) when several samples of the same prompt are wanted."""
+        rate_limit = dict(config.get('rate_limit') or {})
+        if max_concurrency:
+            rate_limit['max_concurrency'] = max_concurrency
+        cache = CompletionCache.from_config(config) if use_cache else None
+        return cls(config['base_url'], config['request_config'], rate_limit, cache=cache)
+
+    def estimate_tokens(self, messages: List[Dict], output_tokens: int = None) -> int:
+        if output_tokens is None:
+            output_tokens = self.request_config.get('max_tokens', self.rate_limit['expected_output_tokens'])
+        return sum(len(message['content']) for message in messages) // 4 + output_tokens
+
+    def key(self, messages: List[Dict]) -> str:
+        return completion_key(self.base_url, self.request_config, messages)
+
+    def prefetch(self, key: str, content: str):
+        """Completion of the messages of key, used once by complete instead of a request."""
+        self.prefetched[key] = content
+
+    async def complete(self, messages: List[Dict], parse: Callable = None, refresh=False, make_check: Callable = None):
+        """Content of the first choice of a chat completion of messages with request_config, or parse(content).
+
+        A completion is cached only if parse accepts it (does not raise); refresh sends the request
+        again even if it is cached (e.g. to retry a completion rejected by a later check), and
+        replaces the cached completion. A prefetched completion is used even with refresh (it was just
+        generated, e.g. by a batch of this run); if parse rejects it, it is requested again (and counted in stats).
+        make_check returns a new incremental check, called with each piece of the output: the
+        completion is then streamed, and cancelled as soon as the check raises (the error is raised
+        again here). Cached and prefetched completions go through a new check as a whole, and its
+        error is raised the same way."""
+        key = self.key(messages)
+        content = self.prefetched.pop(key, None)
+        if content is not None:
+            if make_check:
+                make_check()(content)
+            try:
+                result = parse(content) if parse else content
+                if self.cache:
+                    self.cache.put(key, content)
+                return result
+            except Exception:
+                self.stats['rejected_prefetched'] += 1
+        if self.cache and not refresh:
+            content = self.cache.get(key)
+            if content is not None:
+                if make_check:
+                    make_check()(content)
+                return parse(content) if parse else content
+        content = await self._request(messages, make_check)
+        result = parse(content) if parse else content
+        if self.cache:
+            self.cache.put(key, content)
+        return result
+
+    async def _create(self, messages: List[Dict], check: Callable = None) -> Tuple[str, int]:
+        """Content and total tokens (None if unknown) of a completion, streamed through check if given."""
+        if check is None:
+            completion = await self.client.chat.completions.create(messages=messages, **self.request_config)
+            usage = getattr(completion, 'usage', None)
+            return completion.choices[0].message.content, usage.total_tokens if usage is not None else None
+        stream = await self.client.chat.completions.create(
+            messages=messages, stream=True, stream_options={"include_usage": True}, **self.request_config
+        )
+        parts, total_tokens = [], None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    total_tokens = chunk.usage.total_tokens
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                try:
+                    check(parts[-1])
+                except Exception as e:
+                    raise StreamAborted(e, ''.join(parts))
+        finally:
+            # closing the response cancels the generation
+            await stream.close()
+        return ''.join(parts), total_tokens
+
+    async def _request(self, messages: List[Dict], make_check: Callable = None) -> str:
+        estimate = self.estimate_tokens(messages)
+        for attempt in range(self.rate_limit['max_retries'] + 1):
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimate)
+            started = await self.concurrency.acquire()
+            success = overloaded = False
+            try:
+                self.stats['requests'] += 1
+                content, total_tokens = await self._create(messages, make_check() if make_check else None)
+                success = True
+            except StreamAborted as e:
+                success = True
+                self.stats['aborted'] += 1
+                self.tokens.adjust(self.estimate_tokens(messages, len(e.content) // 4) - estimate)
+                raise e.error
+            except Exception as e:
+                overloaded = _is_overload(e)
+                self.stats['rate_limited'] += isinstance(e, openai.RateLimitError)
+                if not _is_transient(e) or attempt == self.rate_limit['max_retries']:
+                    self.stats['failed'] += 1
+                    raise
+                self.stats['retries'] += 1
+                delay = min(self.rate_limit['backoff_max'], self.rate_limit['backoff_base'] * 2 ** attempt)
+                await asyncio.sleep(max(_retry_after(e), random.uniform(delay / 2, delay)))
+                continue
+            finally:
+                await self.concurrency.release(started, success, overloaded)
+            if total_tokens is not None:
+                self.tokens.adjust(total_tokens - estimate)
+            return content
+
+    def summary(self) -> Dict:
+        """Request counters, and cache hits and misses if there is a cache."""
+        if self.cache is None:
+            return dict(self.stats)
+        return self.stats | {'cache_hits': self.cache.stats['hits'], 'cache_misses': self.cache.stats['misses']}
+
+    async def close(self):
+        await self.client.close()
+        if self.cache:
+            self.cache.close()
+
+
+async def gather_with_progress(coroutines: Iterable[Awaitable], total: int = None) -> List:
+    """Run coroutines concurrently with a progress bar. An exception fails its own coroutine
+    only: it is printed and returned in place of the result."""
+    async def run(coroutine):
+        try:
+            return await coroutine
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+            return e
+    tasks = [asyncio.ensure_future(run(coroutine)) for coroutine in coroutines]
+    for task in tqdm(asyncio.as_completed(tasks), total=total or len(tasks)):
+        await task
+    return [task.result() for task in tasks]
+
+
+async def gather_grouped(groups: List[List[Callable[[], Awaitable]]], max_active_groups=8) -> List[List]:
+    """Run groups of requests sharing a prompt prefix (coroutine functions), with a progress bar.
+
+    At most max_active_groups groups are in flight, in the given order, so that the requests of
+    a group are sent close together in time; the first request of a group is sent alone, the
+    others once it is done and its prefix is in the cache of the endpoint. Exceptions are printed
+    and returned in place of the results, as in gather_with_progress."""
+    semaphore = asyncio.Semaphore(max_active_groups)
+    progress = tqdm(total=sum(len(group) for group in groups))
+
+    async def run(function):
+        try:
+            return await function()
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+            return e
+        finally:
+            progress.update(1)
+
+    async def run_group(group):
+        async with semaphore:
+            if not group:
+                return []
+            first = await run(group[0])
+            return [first] + list(await asyncio.gather(*(run(function) for function in group[1:])))
+
+    try:
+        return list(await asyncio.gather(*(run_group(group) for group in groups)))
+    finally:
+        progress.close()
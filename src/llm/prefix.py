@@ -0,0 +1,50 @@
+from typing import Dict, List, Tuple
+
+
+def _paragraph_start(template: str, position: int) -> int:
+    start = template.rfind('\n\n', 0, position)
+    return 0 if start < 0 else start + 2
+
+
+def split_template(template: str, fields=('source', 'missing')) -> Tuple[str, str]:
+    """Split a prompt template into its shared part, the same for every prompt made from it, and the
+    template of the part that changes with each prompt.
+
+    The variable part goes from the paragraph of the first field (with the paragraph introducing
+    it, when it ends with a colon) to the end of the paragraph of the last one; the shared part is
+    what comes before and after it, already formatted (escaped braces are unescaped)."""
+    positions = [template.index('{' + field + '}') for field in fields]
+    start = _paragraph_start(template, min(positions))
+    previous = _paragraph_start(template, start - 2) if start > 0 else 0
+    if start > 0 and template[previous:start].rstrip().endswith(':'):
+        start = previous
+    end = template.find('\n\n', max(positions))
+    end = len(template) if end < 0 else end
+    head, tail = template[:start].strip('\n'), template[end:].strip('\n')
+    shared = '\n\n'.join(part for part in (head, tail) if part).format()
+    return shared, template[start:end].strip('\n')
+
+
+def prefix_messages(shared: str, body: str, **fields) -> List[Dict]:
+    """Chat messages with the shared part first, as a system message, so that every prompt of a
+    template starts with the same tokens (provider and vLLM prefix caches key on the first tokens)."""
+    return [
+        {"role": "system", "content": shared},
+        {"role": "user", "content": body.format(**fields)},
+    ]
+
+
+def cached_prefix_report(groups: List[List[Tuple[int, int]]], block_tokens=128, min_prefix_tokens=1024) -> Dict:
+    """Estimated share of prompt tokens read from a prefix cache when the requests of each group
+    (their shared prefix and total prompt tokens) are sent one after the other group.
+
+    The first request of a group fills the cache; the next ones reuse the prefix, counted in
+    blocks of block_tokens and only if it has at least min_prefix_tokens tokens (the rules of the
+    OpenAI prompt cache; vLLM caches blocks of 16 tokens, without a minimum)."""
+    total = cached = 0
+    for group in groups:
+        for k, (prefix_tokens, prompt_tokens) in enumerate(group):
+            total += prompt_tokens
+            if k > 0 and prefix_tokens >= min_prefix_tokens:
+                cached += prefix_tokens // block_tokens * block_tokens
+    return {"prompt_tokens": total, "cached_prefix_tokens": cached, "cached_fraction": cached / max(total, 1)}
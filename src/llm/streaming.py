@@ -0,0 +1,63 @@
+import re
+import json
+from typing import Dict, List
+
+# the only characters that change the state of the parser
+TOKEN_PATTERN = re.compile(r'[\\"{}\[\]]')
+
+
+class ItemsParser:
+    """Incremental parser of the objects of a JSON array under key, as in `{"items": [{...}, {...}]}`,
+    for outputs received piece by piece: feed returns the objects completed by each new piece."""
+
+    def __init__(self, key='items'):
+        self.start_pattern = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+        self.buffer = ''
+        self.position = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.item_start = None
+        self.done = False
+
+    def feed(self, text: str) -> List[Dict]:
+        self.buffer += text
+        if self.position is None:
+            match = self.start_pattern.search(self.buffer)
+            if not match:
+                return []
+            self.position = match.end()
+        items = []
+        position = self.position
+        while not self.done:
+            if self.escape:
+                if position >= len(self.buffer):
+                    break
+                position += 1
+                self.escape = False
+                continue
+            match = TOKEN_PATTERN.search(self.buffer, position)
+            if not match:
+                position = len(self.buffer)
+                break
+            token, position = match.group(0), match.end()
+            if self.in_string:
+                if token == '\\':
+                    self.escape = True
+                elif token == '"':
+                    self.in_string = False
+            elif token == '"':
+                self.in_string = True
+            elif token in '{[':
+                if self.depth == 0:
+                    self.item_start = match.start()
+                self.depth += 1
+            elif self.depth == 0:
+                # end of the array
+                self.done = True
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    items.append(json.loads(self.buffer[self.item_start:position]))
+        self.position = position
+        return items
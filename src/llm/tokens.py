@@ -0,0 +1,25 @@
+from typing import Callable
+
+
+def load_token_counter(model: str) -> Callable[[str], int]:
+    """Number of tokens of a text for model: with tiktoken for OpenAI models (or a tiktoken encoding
+    name such as `o200k_base`), else with the transformers tokenizer of a Hugging Face model id,
+    else about 4 characters per token."""
+    name = model.split('/')[-1]
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except (ImportError, KeyError, ValueError):
+        pass
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model)
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    except (ImportError, OSError, ValueError):
+        pass
+    print(f"No tokenizer found for {model}, counting 4 characters per token")
+    return lambda text: (len(text) + 3) // 4
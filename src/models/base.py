@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List
 from abc import ABC, abstractmethod
 
 import torch
@@ -21,6 +21,23 @@ def pooling(outputs: torch.Tensor, inputs: Dict,  strategy: str = 'cls') -> np.n
         raise NotImplementedError
     return outputs.detach()
 
+def pack_by_token_budget(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """Group indices into batches whose padded size stays under max_batch_tokens.
+    Indices are sorted by length first, so each batch only pads to the length of its
+    longest element; a single element longer than the budget gets its own batch."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    for i in order:
+        # lengths are sorted, so lengths[i] is the padded length of the batch once i is added
+        if current and lengths[i] * (len(current) + 1) > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
 class BaseModel(ABC):
     """Abstract base class for embedding model."""
 
@@ -29,6 +46,31 @@ class BaseModel(ABC):
         """Generate an embedding"""
         pass
 
+    @abstractmethod
+    def token_lengths(self, sentences: List[str], query=False) -> List[int]:
+        """Number of tokens fed to the model for each sentence (after prompt and truncation)."""
+        pass
+
+    def generate_batch(self, sentences: List[str], query=False, max_batch_tokens=8192) -> Tensor:
+        """Generate embeddings for a list of sentences.
+        Sentences are sorted by token length and packed into batches of at most
+        max_batch_tokens padded tokens; embeddings are returned on cpu, in the original order."""
+        if not sentences:
+            return torch.empty((0, 0), dtype=torch.float32)
+        lengths = self.token_lengths(sentences, query=query)
+        result = [None] * len(sentences)
+        with torch.inference_mode():
+            for batch in pack_by_token_budget(lengths, max_batch_tokens):
+                embeddings = self.generate([sentences[i] for i in batch], query=query)
+                embeddings = embeddings.to(torch.float32).cpu()
+                for i, embedding in zip(batch, embeddings):
+                    result[i] = embedding
+        return torch.stack(result)
+
     @abstractmethod
     def name(self) -> str:
         pass
+
+    def revision(self) -> str:
+        """Identifier of the model weights, part of the cache key of embeddings."""
+        return ""
@@ -0,0 +1,35 @@
+import hashlib
+from typing import List
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from src.models.base import BaseModel
+
+
+class FakeEmbedding(BaseModel):
+    """Deterministic embeddings without any weights: each text gets a random unit vector seeded by its hash.
+    Identical texts get identical vectors, anything else is nearly orthogonal. Useful to run the
+    indexes or the retrieval server in tests without downloading a model."""
+
+    def __init__(self, device='cpu', dim=64):
+        super().__init__()
+        self.device = device
+        self.dim = dim
+
+    def _embed(self, text: str) -> Tensor:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        generator = torch.Generator().manual_seed(seed)
+        return torch.randn(self.dim, generator=generator)
+
+    def token_lengths(self, sentences: List[str], query=False) -> List[int]:
+        return [len(sentence.split()) + 1 for sentence in sentences]
+
+    def generate(self, sentence: str, query=False) -> Tensor:
+        sentences = [sentence] if isinstance(sentence, str) else sentence
+        embeddings = torch.stack([self._embed(s) for s in sentences])
+        return F.normalize(embeddings, p=2, dim=1).to(self.device)
+
+    def name(self) -> str:
+        return f"fake_{self.dim}"
@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from torch import Tensor
 import torch.nn.functional as F
@@ -24,17 +26,25 @@ class GteQwenEmbedding(BaseModel):
     def __init__(self, device:str):
         super().__init__()
         model_id = 'Alibaba-NLP/gte-Qwen2-7B-instruct'
+        self.model_id = model_id
         self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
         self.model = AutoModel.from_pretrained(model_id, trust_remote_code=True).to(device, dtype=torch.bfloat16)
         self.prompt_query = 'Given a natural language query, retrieve formal Coq statements whose docstrings best match the intent of the query.'
     
+    def _prepare(self, sentence, query=False):
+        if not query:
+            return sentence
+        if isinstance(sentence, str):
+            return get_detailed_instruct(self.prompt_query, sentence)
+        return [get_detailed_instruct(self.prompt_query, s) for s in sentence]
+
+    def token_lengths(self, sentences: List[str], query=False) -> List[int]:
+        batch_dict = self.tokenizer(self._prepare(sentences, query=query), truncation=True)
+        return [len(ids) for ids in batch_dict['input_ids']]
+
     def generate(self, sentence:str, query=False) -> Tensor:
-        if query:
-            input_text = get_detailed_instruct(self.prompt_query, sentence)
-        else:
-            input_text = sentence
-        
+        input_text = self._prepare(sentence, query=query)
         batch_dict = self.tokenizer(input_text, padding=True, truncation=True, return_tensors='pt').to(self.device)
         outputs = self.model(**batch_dict)
         embeddings = last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
@@ -42,4 +52,7 @@ class GteQwenEmbedding(BaseModel):
         return embeddings
 
     def name(self) -> str:
-        return "gte_qwen"
\ No newline at end of file
+        return "gte_qwen"
+
+    def revision(self) -> str:
+        return f"{self.model_id}@{getattr(self.model.config, '_commit_hash', None) or 'main'}"
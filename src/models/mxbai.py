@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List
 
 import torch
 from torch import Tensor
@@ -30,16 +30,30 @@ class MxbaiEmbedding(BaseModel):
         super().__init__()
         self.device = device
         model_id = 'mixedbread-ai/mxbai-embed-large-v1'
+        self.model_id = model_id
         self.tokenizer = AutoTokenizer.from_pretrained(model_id)
         self.model = AutoModel.from_pretrained(model_id).to(device, dtype=torch.bfloat16)
 
+    def _prepare(self, sentence, query=False):
+        if not query:
+            return sentence
+        if isinstance(sentence, str):
+            return transform_query(sentence)
+        return [transform_query(s) for s in sentence]
+
+    def token_lengths(self, sentences: List[str], query=False) -> List[int]:
+        inputs = self.tokenizer(self._prepare(sentences, query=query), truncation=True)
+        return [len(ids) for ids in inputs['input_ids']]
+
     def generate(self, sentence:str, query=False) -> Tensor:
-        if query:
-            sentence = transform_query(sentence)
+        sentence = self._prepare(sentence, query=query)
         inputs = self.tokenizer(sentence, padding=True, return_tensors='pt', truncation=True).to(self.device)
         outputs = self.model(**inputs).last_hidden_state
         embeddings = pooling(outputs, inputs, 'cls')
         return F.normalize(embeddings, p=2, dim=1) 
 
     def name(self) -> str:
-        return "mxbai"
\ No newline at end of file
+        return "mxbai"
+
+    def revision(self) -> str:
+        return f"{self.model_id}@{getattr(self.model.config, '_commit_hash', None) or 'main'}"
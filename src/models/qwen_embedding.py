@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from torch import Tensor
 import torch.nn.functional as F
@@ -25,17 +27,25 @@ class Qwen3Embedding(BaseModel):
         super().__init__()
         assert size in ['0.6B', '4B', '8B']
         model_id = 'Qwen/Qwen3-Embedding-' + size
+        self.model_id = model_id
         self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
         self.model = AutoModel.from_pretrained(model_id, trust_remote_code=True).to(device, dtype=torch.float32)
         self.prompt_query = 'Given a natural language query, retrieve formal Coq statements whose docstrings best match the intent of the query.'
     
+    def _prepare(self, sentence, query=False):
+        if not query:
+            return sentence
+        if isinstance(sentence, str):
+            return get_detailed_instruct(self.prompt_query, sentence)
+        return [get_detailed_instruct(self.prompt_query, s) for s in sentence]
+
+    def token_lengths(self, sentences: List[str], query=False) -> List[int]:
+        batch_dict = self.tokenizer(self._prepare(sentences, query=query), truncation=True)
+        return [len(ids) for ids in batch_dict['input_ids']]
+
     def generate(self, sentence:str, query=False) -> Tensor:
-        if query:
-            input_text = get_detailed_instruct(self.prompt_query, sentence)
-        else:
-            input_text = sentence
-        
+        input_text = self._prepare(sentence, query=query)
         batch_dict = self.tokenizer(input_text, padding=True, truncation=True, return_tensors='pt').to(self.device)
         outputs = self.model(**batch_dict)
         embeddings = last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
@@ -45,6 +55,9 @@ class Qwen3Embedding(BaseModel):
     def name(self) -> str:
         return "qwen_embedding_base"
 
+    def revision(self) -> str:
+        return f"{self.model_id}@{getattr(self.model.config, '_commit_hash', None) or 'main'}"
+
 class Qwen3Embedding600m(Qwen3Embedding):
     def __init__(self, device):
         super().__init__(device, "0.6B")
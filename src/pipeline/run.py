@@ -0,0 +1,266 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from typing import Dict, List
+
+import yaml
+
+IMPORT_PATTERN = re.compile(r'^[ \t]*(?:from[ \t]+(src(?:\.\w+)*)[ \t]+import[ \t]+(?:\(([\w\s,]*)\)|([\w \t,]*))|import[ \t]+(src(?:\.\w+)+))', re.MULTILINE)
+
+STATE_FILE = "state.json"
+TIMINGS_FILE = "timings.jsonl"
+
+
+class Stage:
+    """One step of the pipeline: `python -m src.<name>.exec <args>`, reading inputs and writing outputs
+    (files or directories)."""
+
+    def __init__(self, name: str, args: List[str] = (), inputs: List[str] = (), outputs: List[str] = ()):
+        self.name = name
+        self.module = f"src.{name}.exec"
+        self.args = [str(arg) for arg in args]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.dependencies = []
+
+    def code_path(self) -> str:
+        return os.path.join(*self.module.split('.')) + '.py'
+
+    def code_paths(self) -> List[str]:
+        """Source files of the stage: its exec.py and the `src.` modules it imports, directly or not."""
+        paths, pending = [], [self.code_path()]
+        while pending:
+            path = pending.pop()
+            if path in paths:
+                continue
+            paths.append(path)
+            pending.extend(_local_imports(path))
+        return sorted(paths)
+
+
+def _local_imports(path: str) -> List[str]:
+    """Paths of the modules of the repository (`src.xxx`) imported by the source file path."""
+    with open(path, 'r') as file:
+        source = file.read()
+    modules = []
+    for match in IMPORT_PATTERN.finditer(source):
+        if match.group(4):
+            modules.append(match.group(4))
+        else:
+            # `from src.llm import client` imports the module src.llm.client
+            names = match.group(2) or match.group(3)
+            modules.append(match.group(1))
+            modules += [f"{match.group(1)}.{name.split()[0]}" for name in names.split(',') if name.strip()]
+    paths = []
+    for module in modules:
+        module_path = os.path.join(*module.split('.')) + '.py'
+        if os.path.isfile(module_path):
+            paths.append(module_path)
+    return paths
+
+
+def _overlap(path: str, other: str) -> bool:
+    path, other = os.path.normpath(path), os.path.normpath(other)
+    return path == other or path.startswith(other + os.sep) or other.startswith(path + os.sep)
+
+
+class Fingerprints:
+    """Content hashes of files and directories. The hash of a file is only computed again
+    when its size or modification time changed since the previous run."""
+
+    def __init__(self, cache: Dict[str, List] = None):
+        self.cache = cache if cache is not None else {}
+
+    def file(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                h.update(block)
+        self.cache[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def path(self, path: str) -> str:
+        """Hash of a file, or of the relative paths and hashes of the files of a directory (None if missing)."""
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha256()
+        for (root, dirs, files) in os.walk(path, topdown=True):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.startswith('.'))
+            for file in sorted(files):
+                filepath = os.path.join(root, file)
+                h.update(f"{os.path.relpath(filepath, path)}\0{self.file(filepath)}\0".encode('utf-8'))
+        return h.hexdigest()
+
+    def stage(self, stage: Stage) -> Dict[str, Dict]:
+        """Fingerprints of the inputs of stage (its code, the local modules it imports and its arguments
+        included) and of its outputs."""
+        inputs = {path: self.path(path) for path in stage.inputs}
+        for path in stage.code_paths():
+            inputs[path] = self.path(path)
+        inputs['args'] = hashlib.sha256('\0'.join(stage.args).encode('utf-8')).hexdigest()
+        return {'inputs': inputs, 'outputs': {path: self.path(path) for path in stage.outputs}}
+
+
+class Pipeline:
+    """Stages linked by their inputs and outputs, run as soon as the stages they depend on are done.
+
+    A stage is up to date when the fingerprints of its inputs and outputs are the ones recorded
+    at the end of its last successful run (outputs must exist): it is skipped, and so are the
+    stages after it unless one of their other inputs changed. Independent stages run concurrently,
+    with the log of each one in <state_dir>/logs/<name>.log; the wall time of every run is kept
+    in <state_dir>/timings.jsonl."""
+
+    def __init__(self, stages: List[Stage], state_dir: str = "export/pipeline", max_parallel: int = 4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir
+        self.max_parallel = max_parallel
+        for stage in stages:
+            stage.dependencies = [
+                other.name for other in stages
+                if other is not stage and any(_overlap(path, output) for path in stage.inputs for output in other.outputs)
+            ]
+        self.order = self._topological_order()
+        self.state = {'stages': {}, 'files': {}}
+        state_path = os.path.join(state_dir, STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as file:
+                self.state = json.load(file)
+        self.fingerprints = Fingerprints(self.state['files'])
+
+    @classmethod
+    def from_config(cls, config_path: str, max_parallel: int = 4) -> "Pipeline":
+        with open(config_path, 'r') as file:
+            config = yaml.safe_load(file)
+        stages = [Stage(name, **stage) for name, stage in config['stages'].items()]
+        return cls(stages, state_dir=config.get('state_dir', "export/pipeline"), max_parallel=max_parallel)
+
+    def _topological_order(self) -> List[str]:
+        order, visiting = [], set()
+        def visit(name):
+            if name in order:
+                return
+            assert name not in visiting, f"Cycle in the pipeline through {name}"
+            visiting.add(name)
+            for dependency in self.stages[name].dependencies:
+                visit(dependency)
+            order.append(name)
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def selection(self, targets: List[str] = None) -> List[str]:
+        """Stages needed for targets (all stages by default), in an order compatible with the dependencies."""
+        if not targets:
+            return list(self.order)
+        for target in targets:
+            assert target in self.stages, f"Unknown stage {target}, expected one of {list(self.stages)}"
+        needed = set()
+        def visit(name):
+            if name not in needed:
+                needed.add(name)
+                for dependency in self.stages[name].dependencies:
+                    visit(dependency)
+        for target in targets:
+            visit(target)
+        return [name for name in self.order if name in needed]
+
+    def is_up_to_date(self, name: str) -> bool:
+        recorded = self.state['stages'].get(name, {}).get('fingerprints')
+        current = self.fingerprints.stage(self.stages[name])
+        return recorded == current and all(current['outputs'].values())
+
+    def _save_state(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_path = os.path.join(self.state_dir, STATE_FILE)
+        # fingerprints may be computed in a worker thread meanwhile: dump a copy of the hash cache
+        state = {'stages': self.state['stages'], 'files': dict(self.state['files'])}
+        with open(state_path + '.tmp', 'w') as file:
+            json.dump(state, file, indent=4, sort_keys=True)
+        os.replace(state_path + '.tmp', state_path)
+
+    async def _execute(self, stage: Stage) -> int:
+        os.makedirs(os.path.join(self.state_dir, 'logs'), exist_ok=True)
+        with open(os.path.join(self.state_dir, 'logs', f'{stage.name}.log'), 'w') as log:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', stage.module, *stage.args, stdout=log, stderr=asyncio.subprocess.STDOUT
+            )
+            return await process.wait()
+
+    async def run(self, targets: List[str] = None, force=False, dry_run=False) -> Dict[str, Dict]:
+        """Run the stages needed for targets, return the status ('skipped', 'done', 'failed',
+        'blocked' or, for a dry run, 'stale') and wall time of each one."""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        tasks = {}
+        report = {}
+
+        async def run_stage(name: str) -> bool:
+            stage = self.stages[name]
+            dependencies = [await tasks[dependency] for dependency in stage.dependencies if dependency in tasks]
+            if not all(dependencies):
+                report[name] = {'status': 'blocked', 'wall_time_s': 0.}
+                return False
+            # a stage after a stale one would run in a real run, whatever its inputs are now
+            upstream_stale = dry_run and any(report[dependency]['status'] == 'stale' for dependency in stage.dependencies if dependency in report)
+            if not force and not upstream_stale and await loop.run_in_executor(None, self.is_up_to_date, name):
+                report[name] = {'status': 'skipped', 'wall_time_s': 0.}
+                return True
+            if dry_run:
+                report[name] = {'status': 'stale', 'wall_time_s': 0.}
+                return True
+            async with semaphore:
+                print(f"[{name}] started")
+                start = time.perf_counter()
+                returncode = await self._execute(stage)
+                wall_time = time.perf_counter() - start
+            ok = returncode == 0
+            report[name] = {'status': 'done' if ok else 'failed', 'wall_time_s': wall_time}
+            print(f"[{name}] {report[name]['status']} in {wall_time:.1f}s")
+            if ok:
+                fingerprints = await loop.run_in_executor(None, self.fingerprints.stage, stage)
+                self.state['stages'][name] = {'fingerprints': fingerprints, 'wall_time_s': wall_time, 'finished_at': time.time()}
+            else:
+                self.state['stages'].pop(name, None)
+            self._save_state()
+            return ok
+
+        for name in self.selection(targets):
+            tasks[name] = asyncio.create_task(run_stage(name))
+        await asyncio.gather(*tasks.values())
+
+        if not dry_run:
+            self._save_state()
+            with open(os.path.join(self.state_dir, TIMINGS_FILE), 'a') as file:
+                file.write(json.dumps({'started_at': time.time(), 'stages': report}) + '\n')
+        return {name: report[name] for name in tasks}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the annotation and benchmark stages whose inputs changed, independent stages concurrently.")
+    parser.add_argument('--config', default='config/pipeline/config.yaml', help="Stages with their arguments, inputs and outputs")
+    parser.add_argument('--stages', nargs='*', default=None, help="Stages to bring up to date, with the stages they depend on (default: all)")
+    parser.add_argument('--max-parallel', default=4, type=int, help="Maximum number of stages running at the same time")
+    parser.add_argument('--force', action='store_true', help="Run the selected stages even if they are up to date")
+    parser.add_argument('--dry-run', action='store_true', help="Only report which stages would run")
+    args = parser.parse_args()
+
+    pipeline = Pipeline.from_config(args.config, max_parallel=args.max_parallel)
+    start = time.perf_counter()
+    report = asyncio.run(pipeline.run(args.stages, force=args.force, dry_run=args.dry_run))
+    for name, result in report.items():
+        dependencies = ', '.join(pipeline.stages[name].dependencies) or '-'
+        print(f"{name:<24} {result['status']:<8} {result['wall_time_s']:>8.1f}s  after: {dependencies}")
+    print(f"Total wall time: {time.perf_counter() - start:.1f}s")
+    if any(result['status'] in ('failed', 'blocked') for result in report.values()):
+        sys.exit(1)
@@ -0,0 +1,117 @@
+import os
+import re
+import time
+import argparse
+from collections import defaultdict
+
+from src.rocq.lexer import remove_comments
+from src.rocq.parser import extract_declarations
+
+
+# regex implementation used by annotation/step_1 before src.rocq.parser, kept as the reference
+def legacy_extract_entries(source_code, delta_line=0):
+    source_code = re.sub(r'\*\)\s*\(\*', '', source_code)
+    source_code = source_code + '\n'
+    pattern = (
+        r'(Lemma|Definition|Notation|Fact|Theorem|Record|Fixpoint)\s+'
+        r'((\".+?\")|(\S+)).*?\.\s*\n'
+    )
+    result = {}
+    for match in re.finditer(pattern, source_code, flags=re.DOTALL):
+        start_line = source_code.count('\n', 0, match.start()) + 1
+        end_line = source_code.count('\n', 0, match.end()) + 1
+        name = match.group(2)
+        if name != '_':
+            result[name] = {
+                "name": name,
+                "kind": match.group(1),
+                "docstring": "",
+                "fullname": remove_comments(match.group(0)).strip(),
+                "start_line": start_line + delta_line,
+                "end_line": end_line + delta_line
+            }
+    return result
+
+def legacy_read_modules(content: str) -> list:
+    match = re.search(r"\sModule\s(|Export\s|Import\s)(?P<name>[_'a-zA-Z0-9]*)\.\s", content)
+    if not match:
+        return [content]
+    result = [content[:match.start()+1]]
+    module_name = match.group("name")
+    module_start = content[match.start()+1:match.end()]
+    close_module = f"End {module_name}."
+    content = content[match.end()-1:]
+    close_idx = content.find(close_module)
+    if close_idx < 0:
+        raise Exception(f"Error: the module {module_name} is not closed.")
+    module_content = legacy_read_modules(content[:close_idx])
+    module_content[0] = module_start + module_content[0]
+    module_content[-1] += f"End {module_name}."
+    result.append((module_name, module_content))
+    content = content[close_idx+len(close_module):]
+    return result + legacy_read_modules(content)
+
+def legacy_flatten_modules(source, parent=""):
+    if isinstance(source, str):
+        return [(parent, source.strip())]
+    if isinstance(source, tuple):
+        module_name, subcontent = source
+        return legacy_flatten_modules(subcontent, parent=f'{parent}.{module_name}' if parent else module_name)
+    result = []
+    for subcontent in source:
+        result += legacy_flatten_modules(subcontent, parent=parent)
+    return result
+
+def legacy_extract_skeleton(content: str):
+    flat_m = legacy_flatten_modules(legacy_read_modules(content))
+    result = {}
+    delta_line = 0
+    for parent, source in flat_m:
+        for entry in legacy_extract_entries(source, delta_line=delta_line).values():
+            result[f"{parent}.{entry['name']}" if parent else entry['name']] = entry
+        delta_line += len(source.split('\n'))-1
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the vernacular parser against the legacy regexes on a preprocessed library, and compare their entries.")
+    parser.add_argument("--library-dir", default="export/output/step_0", help="Directory of the library, without comments and proofs")
+    parser.add_argument("--repeat", default=1, type=int, help="Number of runs of each parser")
+    parser.add_argument("--show", default=5, type=int, help="Number of differing entries printed per file")
+    args = parser.parse_args()
+
+    timings = defaultdict(float)
+    stats = defaultdict(int)
+    for (root, dirs, files) in os.walk(args.library_dir, topdown=True):
+        for file in sorted(files):
+            if not file.endswith('.v'):
+                continue
+            filepath = os.path.join(root, file)
+            with open(filepath, 'r') as fileio:
+                content = fileio.read()
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                legacy = legacy_extract_skeleton(content)
+                timings['legacy'] += time.perf_counter() - start
+                start = time.perf_counter()
+                entries = extract_declarations(content.strip())
+                timings['parser'] += time.perf_counter() - start
+
+            stats['files'] += 1
+            stats['legacy entries'] += len(legacy)
+            stats['parser entries'] += len(entries)
+            only_legacy = [fqn for fqn in legacy if fqn not in entries]
+            only_parser = [fqn for fqn in entries if fqn not in legacy]
+            stats['same fqn'] += len(legacy) - len(only_legacy)
+            stats['same fqn and kind'] += sum(1 for fqn in legacy if fqn in entries and legacy[fqn]['kind'] == entries[fqn]['kind'])
+            stats['only legacy'] += len(only_legacy)
+            stats['only parser'] += len(only_parser)
+            if only_legacy or only_parser:
+                print(f"{filepath}: only legacy {only_legacy[:args.show]}, only parser {only_parser[:args.show]}")
+
+    for key, value in stats.items():
+        print(f"{key}: {value}")
+    for key, value in timings.items():
+        print(f"{key}: {value / args.repeat:.3f}s")
+    if timings['parser']:
+        print(f"speedup: {timings['legacy'] / timings['parser']:.1f}x")
@@ -0,0 +1,101 @@
+import re
+from bisect import bisect_left
+from typing import List, Tuple
+
+# the only tokens that change the state of the lexer; proof keywords must not end an identifier
+TOKEN_PATTERN = re.compile(r"""\(\*|\*\)|"|(?<![\w'.])(Proof|Qed|Abort|Defined)\.""")
+
+
+def strip_source(content: str, comments=True, proofs=True) -> Tuple[str, List[int]]:
+    """Remove comments and/or proof blocks (`Proof.` up to `Qed.`, `Abort.` or `Defined.`) in one pass.
+
+    Comments nest, and strings are lexed inside and outside comments: `"(*"` opens nothing and
+    `(* "*)" *)` is a single comment. Proof keywords inside comments or strings are ignored.
+    An unterminated comment or proof is kept.
+    Return the new content and its line map: for each of its lines, the 1-based line of content
+    on which it starts."""
+    removed = []
+    depth = 0
+    in_string = False
+    proof_start = None
+    comment_start = 0
+    for match in TOKEN_PATTERN.finditer(content):
+        token = match.group(0)
+        if in_string:
+            in_string = token != '"'
+        elif token == '"':
+            in_string = True
+        elif token == '(*':
+            if depth == 0:
+                comment_start = match.start()
+            depth += 1
+        elif token == '*)':
+            if depth > 0:
+                depth -= 1
+                if depth == 0 and comments:
+                    removed.append((comment_start, match.end()))
+        elif depth > 0:
+            continue
+        elif match.group(1) == 'Proof':
+            if proof_start is None:
+                proof_start = match.start()
+        elif proof_start is not None:
+            if proofs:
+                removed.append((proof_start, match.end()))
+            proof_start = None
+    # a proof span is appended after the comments it contains: sorting puts it first
+    removed.sort()
+    return remove_spans(content, removed)
+
+
+def remove_comments(content: str) -> str:
+    """Remove Rocq comments (nested ones included) in content."""
+    return strip_source(content, comments=True, proofs=False)[0]
+
+
+def remove_proofs(content: str) -> str:
+    """Remove `Proof. ... Qed.` blocks (also ended by `Abort.` or `Defined.`) in content."""
+    return strip_source(content, comments=False, proofs=True)[0]
+
+
+def remove_spans(content: str, spans: List[Tuple[int, int]]) -> Tuple[str, List[int]]:
+    """Remove sorted (start, end) spans from content; spans nested in a previous one are skipped.
+    Return the new content and its line map (see strip_source)."""
+    newlines = [match.start() for match in re.finditer('\n', content)]
+    parts = []
+    line_map = []
+    position = 0
+    for start, end in spans + [(len(content), len(content))]:
+        if start < position:
+            continue
+        if position < start:
+            if not parts:
+                line_map.append(bisect_left(newlines, position) + 1)
+            # every newline kept starts a new line, which is the one after it in content
+            first, last = bisect_left(newlines, position), bisect_left(newlines, start)
+            line_map.extend(range(first + 2, last + 2))
+            parts.append(content[position:start])
+        position = end
+    return ''.join(parts), line_map or [1]
+
+
+def collapse_blank_lines(content: str, line_map: List[int]) -> Tuple[str, List[int]]:
+    """Replace runs of empty lines by a single one (as replacing '\\n\\n\\n' by '\\n\\n' until none is left),
+    and update line_map accordingly."""
+    lines = content.split('\n')
+    kept_lines, kept_map = [], []
+    for k, (line, origin) in enumerate(zip(lines, line_map)):
+        # an empty line between two newlines is dropped when the previous one was such a line too
+        interior = line == '' and 0 < k < len(lines) - 1
+        if interior and k > 1 and lines[k - 1] == '':
+            continue
+        kept_lines.append(line)
+        kept_map.append(origin)
+    return '\n'.join(kept_lines), kept_map
+
+
+def strip_content(content: str, line_map: List[int]) -> Tuple[str, List[int]]:
+    """content.strip() (what annotation step_1 writes), with line_map updated for the leading lines removed."""
+    stripped = content.strip()
+    first = content.count('\n', 0, len(content) - len(content.lstrip()))
+    return stripped, line_map[first:first + stripped.count('\n') + 1]
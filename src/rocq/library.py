@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+
+def source_files(directory: str) -> List[str]:
+    """Paths of the .v files below directory, relative to it and sorted, so that every run
+    processes and merges files in the same order."""
+    result = []
+    for (root, dirs, files) in os.walk(directory, topdown=True):
+        for file in files:
+            if file.endswith('.v'):
+                result.append(os.path.relpath(os.path.join(root, file), directory))
+    return sorted(result)
+
+
+def module_name(relpath: str) -> str:
+    """Logical name of a source file from its relative path, e.g. `algebra/ssralg.v` -> `algebra.ssralg`."""
+    return relpath.removesuffix('.v').replace(os.sep, '.')
+
+
+def map_files(function: Callable, relpaths: List[str], *args, max_workers: int = None) -> List:
+    """function(relpath, *args) for each file, spread over max_workers processes (1 runs in this process).
+    Results are returned in the order of relpaths, whatever the order in which workers finish."""
+    if max_workers == 1 or len(relpaths) <= 1:
+        return [function(relpath, *args) for relpath in relpaths]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(function, relpaths, *[[arg] * len(relpaths) for arg in args], chunksize=4))
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tool_version(*modules) -> str:
+    """Hash of the source code of modules: outputs of an older version of a step are not reused."""
+    h = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as file:
+            h.update(file.read())
+    return h.hexdigest()
+
+
+def sync_other_files(library_dir: str, export_dir: str, skip=()):
+    """Copy the files of library_dir that are not .v sources into export_dir, when their size or
+    modification time differ (what shutil.copytree did for them, without rewriting unchanged ones)."""
+    for (root, dirs, files) in os.walk(library_dir, topdown=True):
+        for file in files:
+            relpath = os.path.relpath(os.path.join(root, file), library_dir)
+            if file.endswith('.v') or relpath in skip:
+                continue
+            source, target = os.path.join(library_dir, relpath), os.path.join(export_dir, relpath)
+            stat = os.stat(source)
+            if os.path.exists(target):
+                target_stat = os.stat(target)
+                if (target_stat.st_size, target_stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+
+
+class Manifest:
+    """Content hash of the input of each file processed by a step, and the version of the step.
+
+    A file is up to date if its input hash is unchanged, its output exists and the step code
+    did not change since; the manifest is saved last, after all outputs were written."""
+
+    FILE = "manifest.json"
+
+    def __init__(self, export_dir: str, tool: str):
+        self.path = os.path.join(export_dir, self.FILE)
+        self.export_dir = export_dir
+        self.tool = tool
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('tool') == tool:
+                self.files = manifest['files']
+
+    def is_fresh(self, relpath: str, digest: str) -> bool:
+        return self.files.get(relpath) == digest and os.path.exists(os.path.join(self.export_dir, relpath))
+
+    def stale_files(self, library_dir: str, relpaths: List[str], reusable: Callable = None) -> Tuple[Dict[str, str], List[str]]:
+        """Input hash of each file and the files to process again: new or changed ones, and
+        the ones whose previous result is not reusable(relpath)."""
+        digests = {relpath: file_digest(os.path.join(library_dir, relpath)) for relpath in relpaths}
+        stale = [
+            relpath for relpath in relpaths
+            if not self.is_fresh(relpath, digests[relpath]) or (reusable and not reusable(relpath))
+        ]
+        return digests, stale
+
+    def remove_deleted(self, relpaths: List[str]):
+        """Delete the outputs of the files processed before that are no longer in relpaths."""
+        for relpath in set(self.files) - set(relpaths):
+            path = os.path.join(self.export_dir, relpath)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save(self, files: Dict[str, str]):
+        self.files = files
+        os.makedirs(self.export_dir, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump({'tool': self.tool, 'files': files}, file, indent=4, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
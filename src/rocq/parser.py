@@ -0,0 +1,158 @@
+import re
+from bisect import bisect_left
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+
+DECLARATION_KINDS = ('Lemma', 'Definition', 'Notation', 'Fact', 'Theorem', 'Record', 'Fixpoint')
+PROVED_KINDS = ('Lemma', 'Fact', 'Theorem')
+
+# a sentence ends with a period followed by a blank (or the end of the file), outside strings
+SENTENCE_TOKEN = re.compile(r'"|\.(?=\s|\Z)')
+# only `Module [Export|Import] Name.` qualifies the names it contains, other scopes just need to be closed
+MODULE_PATTERN = re.compile(r"Module\s+(?:(?:Export|Import)\s+)?([_'a-zA-Z0-9]*)\Z")
+SCOPE_PATTERN = re.compile(r"(?:Module|Section)\s+(?:(?:Type|Export|Import)\s+)?([\w']+)")
+END_PATTERN = re.compile(r"End\s+([\w']+)\Z")
+# a declaration keyword anywhere in the sentence, so `Local Notation` or `#[local] Lemma` are found
+NAME_PATTERN = r'\s+((\".+?\")|(\S+))'
+PROOF_END_PATTERN = re.compile(r"(?<![\w'.])(Qed|Abort|Defined)\Z")
+BLANK_PATTERN = re.compile(r'\s*')
+
+
+class LineIndex:
+    """Line numbers of offsets in a text, by bisection on the offsets of its newlines."""
+
+    def __init__(self, text: str):
+        self.newlines = [match.start() for match in re.finditer('\n', text)]
+
+    def line(self, offset: int) -> int:
+        """1-based line of the character at offset."""
+        return bisect_left(self.newlines, offset) + 1
+
+    def newlines_between(self, start: int, end: int) -> int:
+        return bisect_left(self.newlines, end) - bisect_left(self.newlines, start)
+
+
+class Sentence(NamedTuple):
+    start: int
+    end: int
+    parent: str
+
+
+def iter_sentences(content: str) -> Iterator[Tuple[int, int]]:
+    """(start, end) of each vernacular sentence of content, end being just after its period.
+    Periods inside strings do not end sentences; comments must have been removed."""
+    in_string = False
+    start = 0
+    for match in SENTENCE_TOKEN.finditer(content):
+        if match.group(0) == '"':
+            in_string = not in_string
+        elif not in_string:
+            yield start, match.end()
+            start = match.end()
+
+
+def parse_sentences(content: str) -> Iterator[Sentence]:
+    """Sentences of content outside Module/Section/End commands, with the path of the enclosing modules."""
+    stack = []
+    parent = ''
+    for start, end in iter_sentences(content):
+        first = BLANK_PATTERN.match(content, start).end()
+        if content[first:first + 1] not in ('E', 'M', 'S'):
+            yield Sentence(start, end, parent)
+            continue
+        text = content[first:end - 1].rstrip()
+        match = END_PATTERN.match(text)
+        if match:
+            names = [name for name, _ in stack]
+            if match.group(1) in names:
+                del stack[len(names) - 1 - names[::-1].index(match.group(1)):]
+                parent = '.'.join(name for name, qualifies in stack if qualifies)
+            continue
+        match = MODULE_PATTERN.match(text)
+        if match:
+            stack.append((match.group(1), True))
+            parent = '.'.join(name for name, qualifies in stack if qualifies)
+            continue
+        match = SCOPE_PATTERN.match(text)
+        if match and ':=' not in text:
+            stack.append((match.group(1), False))
+            continue
+        yield Sentence(start, end, parent)
+
+
+def declaration_pattern(kinds) -> re.Pattern:
+    """Keyword of one of kinds (not ending an identifier) and the name that follows it."""
+    return re.compile(rf"(?<![\w'])({'|'.join(kinds)}){NAME_PATTERN}", flags=re.DOTALL)
+
+
+def _fqn(parent: str, name: str) -> str:
+    return f'{parent}.{name}' if parent else name
+
+
+def _end_line(content: str, lines: LineIndex, end: int) -> int:
+    """Line following a sentence ending at end, counting the blank lines after it."""
+    blank_end = BLANK_PATTERN.match(content, end).end()
+    return lines.line(end) + max(1, lines.newlines_between(end, blank_end))
+
+
+def extract_declarations(content: str, kinds=DECLARATION_KINDS) -> Dict[str, Dict]:
+    """Declarations of the given kinds in content (without comments, see src.rocq.lexer), by fully qualified name.
+
+    The name is the first token after the keyword, or a quoted string (for notations);
+    declarations named `_` are skipped and, for a repeated name, the last one wins.
+    end_line is the line after the declaration (and its trailing blank lines)."""
+    declaration = declaration_pattern(kinds)
+    lines = LineIndex(content)
+    result = {}
+    for sentence in parse_sentences(content):
+        match = declaration.search(content, sentence.start, sentence.end)
+        if not match or match.group(2) == '_':
+            continue
+        name = match.group(2)
+        result[_fqn(sentence.parent, name)] = {
+            "name":       name,
+            "kind":       match.group(1),
+            "docstring":  "",
+            "fullname":   content[match.start():sentence.end].strip(),
+            "start_line": lines.line(match.start()),
+            "end_line":   _end_line(content, lines, sentence.end),
+        }
+    return result
+
+
+def extract_proved_statements(content: str, kinds=PROVED_KINDS) -> Dict[str, Dict]:
+    """Statements of the given kinds immediately followed by `Proof.`, with their proof
+    (up to `Qed.`, `Abort.` or `Defined.`), by fully qualified name.
+    end_line is the line of the end of the proof."""
+    declaration = declaration_pattern(kinds)
+    lines = LineIndex(content)
+    result = {}
+    statement = None
+    proof_start = None
+    for sentence in parse_sentences(content):
+        text = content[sentence.start:sentence.end - 1].strip()
+        if proof_start is not None:
+            match = PROOF_END_PATTERN.search(text)
+            if not match:
+                continue
+            proof_end = sentence.start + content[sentence.start:sentence.end].rindex(match.group(1))
+            match, statement_sentence = statement
+            statement_end = statement_sentence.end
+            name = match.group(2)
+            result[_fqn(statement_sentence.parent, name)] = {
+                "name":       name,
+                "kind":       match.group(1),
+                "docstring":  "",
+                "proof":      content[proof_start:proof_end],
+                "fullname":   content[match.start():statement_end].strip(),
+                "fullmatch":  content[match.start():sentence.end].strip(),
+                "start_line": lines.line(match.start()),
+                "end_line":   lines.line(sentence.end),
+            }
+            statement = proof_start = None
+        elif statement is not None and text == 'Proof':
+            proof_start = sentence.end
+        else:
+            match = declaration.search(content, sentence.start, sentence.end)
+            statement = (match, sentence) if match and match.group(2) != '_' else None
+    return result
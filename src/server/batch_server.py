@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Dict, Tuple
+
+from openai import AsyncOpenAI
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class BatchServer:
+    """Local stand-in for the OpenAI Batch API (files and batches endpoints), for tests and for
+    endpoints without batch support such as a vLLM server.
+
+    The requests of a batch are sent to the chat completions endpoint of upstream_url, at most
+    max_concurrency at a time, and the results are written in the output file format of the
+    Batch API. Files are kept in storage_dir, batches in memory."""
+
+    def __init__(self, upstream_url: str, storage_dir: str, max_concurrency=16, api_key: str = None):
+        self.upstream = AsyncOpenAI(base_url=upstream_url, api_key=api_key or os.getenv("OPENAI_API_KEY") or "none")
+        self.storage_dir = storage_dir
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.files = {}
+        self.batches = {}
+        self._tasks = set()
+        os.makedirs(storage_dir, exist_ok=True)
+
+    def _store(self, content: bytes, filename: str, purpose: str) -> Dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(os.path.join(self.storage_dir, file_id), 'wb') as file:
+            file.write(content)
+        self.files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+        return self.files[file_id]
+
+    def _read(self, file_id: str) -> bytes:
+        if file_id not in self.files:
+            raise HttpError(404, f"No file {file_id}")
+        with open(os.path.join(self.storage_dir, file_id), 'rb') as file:
+            return file.read()
+
+    def upload(self, content_type: str, body: bytes) -> Dict:
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body)
+        if not message.is_multipart():
+            raise HttpError(400, "Expected multipart/form-data")
+        fields, content, filename = {}, None, "upload.jsonl"
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'file':
+                content, filename = part.get_payload(decode=True), part.get_filename() or filename
+            else:
+                fields[name] = part.get_content().strip()
+        if content is None:
+            raise HttpError(400, "Missing file")
+        return self._store(content, filename, fields.get('purpose', 'batch'))
+
+    async def _request(self, line: Dict) -> Dict:
+        async with self.semaphore:
+            try:
+                completion = await self.upstream.chat.completions.create(**line['body'])
+                response = {"status_code": 200, "request_id": completion.id, "body": completion.model_dump()}
+                return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line['custom_id'], "response": response, "error": None}
+            except Exception as e:
+                error = {"code": type(e).__name__, "message": str(e)}
+                return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line['custom_id'], "response": None, "error": error}
+
+    async def _process(self, batch: Dict):
+        batch["status"], batch["in_progress_at"] = "in_progress", int(time.time())
+        lines = [json.loads(line) for line in self._read(batch["input_file_id"]).decode('utf-8').splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        results = []
+
+        async def run(line):
+            result = await self._request(line)
+            batch["request_counts"]["completed" if result["error"] is None else "failed"] += 1
+            results.append(result)
+
+        await asyncio.gather(*(run(line) for line in lines))
+        batch["status"], batch["finalizing_at"] = "finalizing", int(time.time())
+        output = [result for result in results if result["error"] is None]
+        errors = [result for result in results if result["error"] is not None]
+        if output:
+            batch["output_file_id"] = self._store(''.join(json.dumps(r) + '\n' for r in output).encode('utf-8'), "output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self._store(''.join(json.dumps(r) + '\n' for r in errors).encode('utf-8'), "errors.jsonl", "batch_output")["id"]
+        batch["status"], batch["completed_at"] = "completed", int(time.time())
+
+    def create_batch(self, body: Dict) -> Dict:
+        if body.get('input_file_id') not in self.files:
+            raise HttpError(400, f"No file {body.get('input_file_id')}")
+        if body.get('endpoint') != "/v1/chat/completions":
+            raise HttpError(400, "Only /v1/chat/completions is supported")
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": body['endpoint'], "errors": None,
+            "input_file_id": body['input_file_id'], "completion_window": body.get('completion_window', '24h'),
+            "status": "validating", "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": body.get('metadata'),
+        }
+        self.batches[batch_id] = batch
+        task = asyncio.create_task(self._process(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return batch
+
+    async def dispatch(self, method: str, path: str, headers: Dict, body: bytes) -> Tuple[int, object]:
+        parts = path.split('?', 1)[0].strip('/').split('/')
+        if parts[:1] == ['v1']:
+            parts = parts[1:]
+        if parts == ['files'] and method == 'POST':
+            return 200, self.upload(headers.get('content-type', ''), body)
+        if len(parts) == 2 and parts[0] == 'files':
+            if parts[1] not in self.files:
+                raise HttpError(404, f"No file {parts[1]}")
+            return 200, self.files[parts[1]]
+        if len(parts) == 3 and parts[0] == 'files' and parts[2] == 'content':
+            return 200, self._read(parts[1])
+        if parts == ['batches'] and method == 'POST':
+            return 200, self.create_batch(json.loads(body or b'{}'))
+        if len(parts) == 2 and parts[0] == 'batches':
+            if parts[1] not in self.batches:
+                raise HttpError(404, f"No batch {parts[1]}")
+            return 200, self.batches[parts[1]]
+        raise HttpError(404, f"Unknown path {path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve the requests of one connection (HTTP/1.1 keep-alive)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, payload = await self.dispatch(method, path, headers, body)
+                except HttpError as e:
+                    status, payload = e.status, {"error": {"message": e.message}}
+                except Exception as e:
+                    status, payload = 500, {"error": {"message": f"{type(e).__name__}: {e}"}}
+                if isinstance(payload, bytes):
+                    data, content_type = payload, "application/octet-stream"
+                else:
+                    data, content_type = json.dumps(payload).encode('utf-8'), "application/json"
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8766):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving a batch API on http://{host}:{port}/v1")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible batch API forwarding requests to a chat completions endpoint.")
+    parser.add_argument('--upstream-url', required=True, help="Base url of the chat completions endpoint, e.g. http://localhost:8000/v1 for vLLM")
+    parser.add_argument('--storage-dir', default='export/batch/server', help="Directory of the uploaded and output files")
+    parser.add_argument('--max-concurrency', default=16, type=int, help="Maximum number of requests sent to the upstream endpoint at the same time")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8766, type=int)
+    args = parser.parse_args()
+
+    server = BatchServer(args.upstream_url, args.storage_dir, max_concurrency=args.max_concurrency)
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.models.fake import FakeEmbedding
+from src.models.gteqwen import GteQwenEmbedding
+from src.models.mxbai import MxbaiEmbedding
+from src.models.qwen_embedding import Qwen3Embedding600m, Qwen3Embedding4b, Qwen3Embedding8b
+from src.index.cosim_index import CosimIndex, FaissIndex, load_index_config
+from src.index.hybrid_index import LexicalIndex, HybridIndex
+
+DICT_MODEL = {
+    "fake": FakeEmbedding,
+    "gte_qwen": GteQwenEmbedding,
+    "mxbai": MxbaiEmbedding,
+    "qwen_embedding_600m": Qwen3Embedding600m,
+    "qwen_embedding_4b": Qwen3Embedding4b,
+    "qwen_embedding_8b": Qwen3Embedding8b,
+}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# filters of ConstantTable.select and whether they take a list of strings (or one string)
+FILTER_KEYS = {'module_prefix': False, 'kinds': True, 'exclude_kinds': True, 'files': True}
+
+
+def validate_filters(filters):
+    """Raise a 400 HttpError unless filters is an object of known filters with values of the right type."""
+    if not isinstance(filters, dict):
+        raise HttpError(400, "Expected 'filters' to be an object")
+    for key, value in filters.items():
+        if key not in FILTER_KEYS:
+            raise HttpError(400, f"Unknown filter {key!r}, expected one of {', '.join(FILTER_KEYS)}")
+        if FILTER_KEYS[key]:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise HttpError(400, f"Filter {key!r} must be a list of strings")
+        elif not isinstance(value, str):
+            raise HttpError(400, f"Filter {key!r} must be a string")
+
+
+class MicroBatcher:
+    """Gather concurrent queries into batches for CosimIndex.query_batch.
+
+    The first pending query opens a window of window_ms milliseconds (or until max_batch_size
+    queries are pending); the queries of the window are grouped by filters, answered with one
+    query_batch call per group in a worker thread, and each caller gets its own top_k."""
+
+    def __init__(self, index: CosimIndex, window_ms=5., max_batch_size=64):
+        self.index = index
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+        self.batch_sizes = deque(maxlen=1000)
+        self.batch_latencies = deque(maxlen=1000)
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+
+    async def query(self, query: str, top_k=10, filters: Dict = None) -> List[Tuple[float, str, str]]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, filters, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple]:
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups = {}
+            for item in batch:
+                groups.setdefault(json.dumps(item[2], sort_keys=True), []).append(item)
+            start = time.perf_counter()
+            for items in groups.values():
+                queries = [query for query, _, _, _ in items]
+                top_k = max(top_k for _, top_k, _, _ in items)
+                try:
+                    results = await loop.run_in_executor(None, self.index.query_batch, queries, top_k, items[0][2])
+                except Exception as e:
+                    for _, _, _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, top_k, _, future), result in zip(items, results):
+                    if not future.done():
+                        future.set_result(result[:top_k])
+            self.batch_sizes.append(len(batch))
+            self.batch_latencies.append((time.perf_counter() - start) * 1000)
+
+
+class RetrievalServer:
+    """Minimal HTTP/JSON server around a CosimIndex, the index and its model stay loaded.
+
+    - GET /health: status and number of indexed constants
+    - GET /stats: request and batch counts, latency percentiles (ms) over the last 1000 requests
+    - POST /query: {"query": str or "queries": [str], "top_k": int, "filters": {...}}
+      returns {"results": [[{"score", "fqn", "constant"}]]}, one list per query"""
+
+    def __init__(self, index: CosimIndex, window_ms=5., max_batch_size=64, max_top_k=100, refresh_interval=0.):
+        self.index = index
+        self.batcher = MicroBatcher(index, window_ms=window_ms, max_batch_size=max_batch_size)
+        self.max_top_k = max_top_k
+        self.refresh_interval = refresh_interval
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+
+    def _size(self) -> int:
+        index = self.index.dense if isinstance(self.index, HybridIndex) else self.index
+        return len(index.all_fqn)
+
+    async def _refresh(self):
+        """Pick up the index versions published by update_cache.py (see FaissIndex.refresh)."""
+        dense = self.index.dense if isinstance(self.index, HybridIndex) else self.index
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            if await loop.run_in_executor(None, dense.refresh):
+                print(f"Switched to index version {dense.snapshot.version}")
+
+    def stats(self) -> Dict:
+        def percentile(values, q):
+            return float(np.percentile(values, q)) if values else 0.
+        batch_sizes = self.batcher.batch_sizes
+        return {
+            "uptime_s": time.time() - self.started,
+            "requests": self.requests,
+            "errors": self.errors,
+            "pending": self.batcher.queue.qsize(),
+            "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.,
+            "latency_p50_ms": percentile(self.latencies, 50),
+            "latency_p99_ms": percentile(self.latencies, 99),
+            "batch_p50_ms": percentile(self.batcher.batch_latencies, 50),
+            "batch_p99_ms": percentile(self.batcher.batch_latencies, 99),
+        }
+
+    async def query(self, body: Dict) -> Dict:
+        queries = body.get('queries', [body['query']] if 'query' in body else None)
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise HttpError(400, "Expected a 'query' string or a 'queries' list of strings")
+        top_k = body.get('top_k', 10)
+        if not isinstance(top_k, int) or not 0 < top_k <= self.max_top_k:
+            raise HttpError(400, f"top_k must be an integer between 1 and {self.max_top_k}")
+        filters = body.get('filters') or None
+        if filters is not None:
+            validate_filters(filters)
+        results = await asyncio.gather(*(self.batcher.query(query, top_k, filters) for query in queries))
+        return {"results": [
+            [{"score": float(score), "fqn": fqn, "constant": dict(constant)} for score, constant, fqn in result]
+            for result in results
+        ]}
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        path = path.split('?', 1)[0]
+        if path == '/health':
+            return 200, {"status": "ok", "index": type(self.index).__name__, "constants": self._size()}
+        if path == '/stats':
+            return 200, self.stats()
+        if path != '/query':
+            raise HttpError(404, f"Unknown path {path}")
+        if method != 'POST':
+            raise HttpError(405, "Use POST for /query")
+        try:
+            body = json.loads(body or b'{}')
+        except json.JSONDecodeError as e:
+            raise HttpError(400, f"Invalid JSON: {e}")
+        if not isinstance(body, dict):
+            raise HttpError(400, "Expected a JSON object")
+        return 200, await self.query(body)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve the requests of one connection (HTTP/1.1 keep-alive)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                start = time.perf_counter()
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self.requests += 1
+                try:
+                    status, payload = await self.dispatch(method, path, body)
+                except HttpError as e:
+                    status, payload = e.status, {"error": e.message}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                if status != 200:
+                    self.errors += 1
+                self.latencies.append((time.perf_counter() - start) * 1000)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        self.batcher.start()
+        refresh = asyncio.create_task(self._refresh()) if self.refresh_interval > 0 else None
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving {type(self.index).__name__} on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if refresh:
+                refresh.cancel()
+            await self.batcher.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve natural language retrieval over HTTP/JSON, keeping the model and the index loaded.")
+    parser.add_argument('--database-path', default='export/output/step_3/result.json', help='Database path (ignored if --from-index is set)')
+    parser.add_argument('--from-index', action='store_true', help="Load the index saved in --index-path without reading the database")
+    parser.add_argument('--model-name', default='mxbai', help="Embedding model's name ('fake' needs no weights)")
+    parser.add_argument('--device', default='cpu', help="Device for embedding model")
+    parser.add_argument('--index-path', default='export/index/', help="Directory where the built index is saved and loaded from")
+    parser.add_argument('--index-config', default='config/index/config.yaml', help="Index build parameters")
+    parser.add_argument('--index-type', default=None, help="flat, hnsw, ivf_flat or ivf_pq (default: the one selected in --index-config)")
+    parser.add_argument('--storage', default=None, help="fp32, fp16, sq8 or pq (default: the one selected in --index-config)")
+    parser.add_argument('--max-batch-tokens', default=8192, type=int, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--retrieval', default='dense', choices=['dense', 'lexical', 'hybrid'], help="Dense embeddings, BM25 only, or both fused")
+    parser.add_argument('--fusion', default='rrf', choices=['rrf', 'weighted'], help="Rank fusion used by hybrid retrieval")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--batch-window-ms', default=5., type=float, help="Time window used to gather concurrent queries into one batch")
+    parser.add_argument('--max-batch-size', default=64, type=int, help="Maximum number of queries per batch")
+    parser.add_argument('--refresh-interval', default=0., type=float, help="Seconds between checks for a newly published dense index (0 to disable)")
+    args = parser.parse_args()
+
+    database = None
+    if not args.from_index:
+        with open(args.database_path, 'r') as file:
+            database = json.load(file)
+
+    if args.retrieval != 'lexical':
+        model = DICT_MODEL[args.model_name](device=args.device)
+        index_config = load_index_config(args.index_config, index_type=args.index_type, storage=args.storage)
+        index = FaissIndex(model, database, max_batch_tokens=args.max_batch_tokens, index_path=args.index_path, index_config=index_config)
+    if args.retrieval != 'dense':
+        lexical_index = LexicalIndex(database, index_path=args.index_path)
+        index = lexical_index if args.retrieval == 'lexical' else HybridIndex(index, lexical_index, fusion=args.fusion)
+
+    server = RetrievalServer(
+        index, window_ms=args.batch_window_ms, max_batch_size=args.max_batch_size,
+        refresh_interval=args.refresh_interval if args.retrieval != 'lexical' else 0.
+    )
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,21 @@
+from src.llm.cache import CompletionCache
+
+
+def test_running_size_and_lru_eviction(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'llm.sqlite'), max_size_mb=1000 / 2 ** 20)
+    for k in range(8):
+        cache.put(f'key{k}', 'x' * 100)
+    cache.put('key0', 'y' * 200)
+    assert cache.total_size == 900 == cache._sum_size()
+    assert cache.get('key1') == 'x' * 100
+
+    # over the budget: the least recently used completions are evicted
+    cache.put('key8', 'z' * 300)
+    assert cache.total_size == cache._sum_size() <= 1000
+    assert 'key2' not in cache and 'key3' not in cache
+    assert 'key1' in cache and 'key8' in cache
+    cache.close()
+
+    reopened = CompletionCache(str(tmp_path / 'llm.sqlite'), max_size_mb=1000 / 2 ** 20)
+    assert reopened.total_size == cache.total_size
+    reopened.close()
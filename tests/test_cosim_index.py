@@ -0,0 +1,29 @@
+from src.index.cosim_index import FaissIndex
+from src.models.fake import FakeEmbedding
+
+
+def make_database(docstrings):
+    return {'lib.a': {
+        f'c{i}': {'name': f'c{i}', 'kind': 'Lemma', 'docstring': docstring, 'fullname': f'Lemma c{i}.', 'start_line': i, 'end_line': i + 1}
+        for i, docstring in enumerate(docstrings)
+    }}
+
+
+def test_refresh_loads_version_published_by_another_instance(tmp_path):
+    model = FakeEmbedding(dim=16)
+    old = make_database([f'old docstring {i}' for i in range(20)])
+    new = make_database([f'old docstring {i}' for i in range(15)] + [f'new docstring {i}' for i in range(8)])
+    paths = {'cache_path': str(tmp_path / 'cache'), 'index_path': str(tmp_path / 'index')}
+
+    reader = FaissIndex(model, old, **paths)
+    # e.g. update_cache.py in another process: embeds the new docstrings and publishes a version
+    writer = FaissIndex(model, **paths)
+    result = writer.apply_delta(old, new)
+    assert result['added'] == 8
+
+    assert reader.refresh()
+    assert reader.snapshot.version == result['version']
+    (score, constant, fqn), = reader.query('new docstring 3', top_k=1)
+    assert fqn == 'lib.a.c18'
+    assert constant['docstring'] == 'new docstring 3'
+    assert not reader.refresh()
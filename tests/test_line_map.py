@@ -0,0 +1,40 @@
+import os
+
+from src.annotation.step_0.exec import process_file as preprocess_file
+from src.annotation.step_1.exec import process_file as parse_file
+
+SOURCE = """(* Header comment
+   spanning lines *)
+
+
+Definition d0 := 0.
+
+Lemma l1 x :
+  x = x.
+Proof.
+  reflexivity.
+Qed.
+
+
+
+(* between *)
+Definition d2 := 2.
+"""
+
+
+def test_step_1_lines_map_back_to_the_library(tmp_path):
+    library_dir, step_0_dir, step_1_dir = (str(tmp_path / name) for name in ('library', 'step_0', 'step_1'))
+    os.makedirs(library_dir)
+    with open(os.path.join(library_dir, 'a.v'), 'w') as file:
+        file.write(SOURCE)
+
+    line_map = preprocess_file('a.v', library_dir, step_0_dir)
+    skeleton = parse_file('a.v', step_0_dir, step_1_dir)
+    with open(os.path.join(step_1_dir, 'a.v'), 'r') as file:
+        assert len(file.read().split('\n')) == len(line_map)
+
+    original_lines = SOURCE.split('\n')
+    assert len(skeleton) == 3
+    for entry in skeleton.values():
+        line = original_lines[line_map[entry['start_line'] - 1] - 1]
+        assert entry['name'] in line
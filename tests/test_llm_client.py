@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+
+from src.llm.client import LLMClient
+
+MESSAGES = [{"role": "user", "content": "Annotate"}]
+
+
+class OutOfTolerance(Exception):
+    pass
+
+
+def make_client(monkeypatch):
+    """Client whose live requests return an empty list of items, and count them."""
+    monkeypatch.setenv("OPENAI_API_KEY", "none")
+    client = LLMClient("http://127.0.0.1:1/v1", {"model": "test"})
+    sent = []
+
+    async def request(messages, make_check=None):
+        sent.append(messages)
+        return '{"items": []}'
+
+    client._request = request
+    return client, sent
+
+
+def complete(client, **kwargs):
+    async def main():
+        try:
+            return await client.complete(MESSAGES, parse=lambda content: json.loads(content)['items'], **kwargs)
+        finally:
+            await client.close()
+    return asyncio.run(main())
+
+
+def test_prefetched_completion_is_used_with_refresh(monkeypatch):
+    client, sent = make_client(monkeypatch)
+    client.prefetch(client.key(MESSAGES), '{"items": [{"name": "a"}]}')
+    assert complete(client, refresh=True) == [{"name": "a"}]
+    assert sent == []
+
+
+def test_prefetched_completion_rejected_by_parse_is_requested_again(monkeypatch):
+    client, sent = make_client(monkeypatch)
+    client.prefetch(client.key(MESSAGES), 'not json')
+    assert complete(client) == []
+    assert sent == [MESSAGES]
+    assert client.stats['rejected_prefetched'] == 1
+
+
+def test_check_error_of_prefetched_completion_is_raised(monkeypatch):
+    client, sent = make_client(monkeypatch)
+    client.prefetch(client.key(MESSAGES), '{"items": [{"name": "wrong"}]}')
+
+    def make_check():
+        def check(text):
+            raise OutOfTolerance(text)
+        return check
+
+    with pytest.raises(OutOfTolerance):
+        complete(client, make_check=make_check)
+    assert sent == []
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import pytest
+
+from src.index.cosim_index import FaissIndex
+from src.models.fake import FakeEmbedding
+from src.server.retrieval_server import RetrievalServer
+
+
+def make_database(n):
+    return {'lib.a': {
+        f'c{i}': {'name': f'c{i}', 'kind': 'Lemma' if i % 2 else 'Definition', 'docstring': f'docstring {i}', 'fullname': f'c{i}', 'start_line': i, 'end_line': i + 1}
+        for i in range(n)
+    }}
+
+
+async def post(port, body):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode('utf-8')
+    writer.write(f"POST /query HTTP/1.1\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+
+def run_server(tmp_path, requests):
+    """Results of the requests, sent at the same time to a server on a FakeEmbedding index."""
+    index = FaissIndex(FakeEmbedding(dim=16), make_database(40), cache_path=str(tmp_path / 'cache'))
+    server = RetrievalServer(index, window_ms=50.)
+
+    async def main():
+        server.batcher.start()
+        http = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = http.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*(post(port, body) for body in requests))
+        finally:
+            http.close()
+            await server.batcher.stop()
+
+    return server, asyncio.run(main())
+
+
+def test_concurrent_queries_are_batched(tmp_path):
+    server, responses = run_server(tmp_path, [{'query': f'docstring {i}', 'top_k': 3} for i in range(20)])
+    for i, (status, payload) in enumerate(responses):
+        assert status == 200
+        result, = payload['results']
+        assert len(result) == 3
+        assert result[0]['fqn'] == f'lib.a.c{i}'
+    assert max(server.batcher.batch_sizes) > 1
+    assert sum(server.batcher.batch_sizes) == 20
+
+
+def test_filters(tmp_path):
+    _, responses = run_server(tmp_path, [{'query': 'docstring 3', 'top_k': 5, 'filters': {'kinds': ['Definition']}}])
+    (status, payload), = responses
+    assert status == 200
+    assert all(entry['constant']['kind'] == 'Definition' for entry in payload['results'][0])
+
+
+@pytest.mark.parametrize('filters', [
+    'Lemma',
+    ['Lemma'],
+    {'kinds': 'Lemma'},
+    {'kinds': ['Lemma', 1]},
+    {'exclude_kinds': 'Lemma'},
+    {'files': [['lib.a']]},
+    {'module_prefix': ['lib']},
+    {'kind': ['Lemma']},
+])
+def test_malformed_filters_are_rejected(tmp_path, filters):
+    server, responses = run_server(tmp_path, [{'query': 'docstring 1', 'filters': filters}])
+    (status, payload), = responses
+    assert status == 400
+    assert 'error' in payload
+    assert server.errors == 1